@@ -12,6 +12,16 @@ logging.basicConfig(level="INFO", format='%(levelname)s: %(message)s')
 
 LOG = logging.getLogger("deploy_seldon")
 
+# keep-alive connections survive in warm containers
+_http_session = None
+
+
+def get_http_session():
+    global _http_session
+    if _http_session is None:
+        _http_session = requests.Session()
+    return _http_session
+
 
 def apply_oid_token_monkey_patch():
     LOG.warning("applying monkey-patch for https://github.com/kubernetes-client/python/issues/525")
@@ -259,7 +269,7 @@ def get_deployment_url(params):
 
 def is_deployment_available(params):
     url = get_deployment_url(params)
-    response = requests.options(url)
+    response = get_http_session().options(url)
     return response.status_code == 200
 
 
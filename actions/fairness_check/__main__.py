@@ -1,50 +1,142 @@
 # OpenWhisk action to perform a model fairness check with AIF360
 
+import boto3
+import hashlib
+import io
+import json
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
-def create_cos_connection(params):
-    import boto3
-    cos = boto3.resource("s3",
-                         endpoint_url=params["aws_endpoint_url"],
-                         aws_access_key_id=params["aws_access_key_id"],
-                         aws_secret_access_key=params["aws_secret_access_key"])
-    return cos
+# COS resources per credentials, kept by warm containers
+_cos_resources = {}
 
+# part of the cache key, increment it whenever the metrics or the result format change
+cache_version = 1
 
-def get_or_create_bucket(cos, bucket_name):
-    bucket = cos.Bucket(bucket_name)
-    if not bucket.creation_date:
-        bucket = cos.create_bucket(Bucket=bucket_name)
-    return bucket
 
+def get_cos_resource(params):
+    key = (params["aws_endpoint_url"], params["aws_access_key_id"],
+           hashlib.sha256(params["aws_secret_access_key"].encode()).hexdigest())
+    if key not in _cos_resources:
+        _cos_resources[key] = boto3.resource("s3",
+                                             endpoint_url=params["aws_endpoint_url"],
+                                             aws_access_key_id=params["aws_access_key_id"],
+                                             aws_secret_access_key=params["aws_secret_access_key"])
+    return _cos_resources[key]
 
-def copy_file(source_bucket, source_file, target_bucket, target_file):
-    if source_bucket != target_bucket or source_file != target_file:
-        target_bucket.copy({"Bucket": source_bucket.name, "Key": source_file}, target_file)
 
+def read_object(s3_client, bucket_name, key):
+    # returns the object content in a memory buffer, or None if the object does not exist
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=key)
+    except boto3.exceptions.botocore.client.ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+    return io.BytesIO(response["Body"].read())
+
+
+def get_object_etag(s3_client, bucket_name, key):
+    # returns the ETag of the object, or None if the object does not exist
+    try:
+        response = s3_client.head_object(Bucket=bucket_name, Key=key)
+    except boto3.exceptions.botocore.client.ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+    return response["ETag"]
 
-def copy_training_result_files(cos, params):
+
+def get_training_result_etags(s3_client, params):
+    # the ETags of the label files, used to detect whether the training results changed since the metrics were cached
+    model_id = params["model_id"]
+    bucket_name = params["training_results_bucket"]
+    etag = get_object_etag(s3_client, bucket_name, "%s/labels.npz" % model_id)
+    if etag is not None:
+        return {"labels.npz": etag}
+    # fall back to the text files written by older versions of the training script, checked at the same time
+    out_files = ["y_test.out", "p_test.out", "y_pred.out"]
+    with ThreadPoolExecutor(max_workers=len(out_files)) as executor:
+        etags = list(executor.map(
+            lambda out_file: get_object_etag(s3_client, bucket_name, "%s/%s" % (model_id, out_file)), out_files))
+    for out_file, etag in zip(out_files, etags):
+        if etag is None:
+            raise ValueError("Could not find '%s/%s' in bucket '%s'" % (model_id, out_file, bucket_name))
+    return dict(zip(out_files, etags))
+
+
+def read_training_result_files(s3_client, params, file_names):
+    # read the (small) label files straight into memory, without checking or creating the bucket first,
+    # the low-level client is thread-safe, unlike boto3 resources
     model_id = params["model_id"]
-    # tdb = get_or_create_bucket(cos, params["training_data_bucket"])
-    trb = get_or_create_bucket(cos, params["training_results_bucket"])
-    for out_file in ["y_test.out", "p_test.out", "y_pred.out"]:
-        src_path = "%s/%s" % (model_id, out_file)
-        trb.download_file(src_path, out_file)
+    bucket_name = params["training_results_bucket"]
+    with ThreadPoolExecutor(max_workers=len(file_names)) as executor:
+        buffers = list(executor.map(
+            lambda file_name: read_object(s3_client, bucket_name, "%s/%s" % (model_id, file_name)), file_names))
+    for file_name, buffer in zip(file_names, buffers):
+        if buffer is None:
+            raise ValueError("Could not find '%s/%s' in bucket '%s'" % (model_id, file_name, bucket_name))
+    return dict(zip(file_names, buffers))
+
+
+def get_fairness_check_options(params):
+    return {
+        "intersectional": params.get("intersectional", False),
+        "group_pairs": params.get("group_pairs"),
+        "age_bins": params.get("age_bins", (20, 40, 60)),
+        "bootstrap": int(params.get("bootstrap", 0)),
+        "confidence": float(params.get("confidence", 0.95)),
+        "seed": params.get("seed")
+    }
 
 
-def get_fairness_check_metrics(params):
+def get_cache_key(params, etags, options):
+    # cached metrics are stored next to the label files, keyed by the cache version, the ETags and the options
+    cache_id = hashlib.sha256(json.dumps([cache_version, sorted(etags.items()), sorted(options.items())])
+                              .encode()).hexdigest()
+    return "%s/fairness_check/%s.json" % (params["model_id"], cache_id)
+
+
+def is_cacheable(options):
+    # bootstrap confidence intervals are only reproducible with a fixed seed
+    return options["bootstrap"] == 0 or options["seed"] is not None
+
+
+def get_fairness_check_metrics(options, label_files):
     from fairness_check import fairness_check
-    metrics = fairness_check(label_dir=".", model_dir=".")
+    metrics = fairness_check(label_dir=".", model_dir=".", label_files=label_files, **options)
+    return metrics
+
+
+def get_cached_fairness_check_metrics(cos, params):
+    s3_client = cos.meta.client
+    bucket_name = params["training_results_bucket"]
+    options = get_fairness_check_options(params)
+    etags = get_training_result_etags(s3_client, params)
+    use_cache = params.get("cache_results", True) and is_cacheable(options)
+    if use_cache:
+        cache_key = get_cache_key(params, etags, options)
+        cached_metrics = read_object(s3_client, bucket_name, cache_key)
+        if cached_metrics is not None:
+            return json.loads(cached_metrics.getvalue().decode())
+    label_files = read_training_result_files(s3_client, params, list(etags))
+    metrics = get_fairness_check_metrics(options, label_files)
+    if use_cache:
+        # caching is best-effort, the computed metrics are returned even if they cannot be stored
+        try:
+            s3_client.put_object(Bucket=bucket_name, Key=cache_key, Body=json.dumps(metrics).encode(),
+                                 ContentType="application/json")
+        except Exception as e:
+            print("Could not cache the metrics in '%s/%s': %s: %s" % (bucket_name, cache_key, e.__class__.__name__, e))
     return metrics
 
 
 def run_safe(args):
     try:
-        cos = create_cos_connection(args)
-        copy_training_result_files(cos, args)
-        metrics = get_fairness_check_metrics(args)
+        cos = get_cos_resource(args)
+        metrics = get_cached_fairness_check_metrics(cos, args)
         return metrics
     except Exception as e:
-        import traceback
         print('%s: %s\n%s' % (e.__class__.__name__, str(e), traceback.format_exc()))
         return {
             "Status": "Error",
@@ -85,5 +177,4 @@ def _load_json_args():
 if __name__ == "__main__":
     params = _load_json_args()
     result = main(params)
-    # result = get_fairness_check_metrics(params)
     print(result)
@@ -1,15 +1,38 @@
 # OpenWhisk action to perform a model fairness check with AIF360 on FfDL
 
-import json, requests
+import boto3
+import hashlib
+import json
+import requests
+import traceback
+import zipfile
+from ruamel.yaml import YAML
+
+# kept by warm containers
+_cos_resources = {}
+_http_session = None
+
+
+def get_cos_resource(params):
+    key = (params["aws_endpoint_url"], params["aws_access_key_id"],
+           hashlib.sha256(params["aws_secret_access_key"].encode()).hexdigest())
+    if key not in _cos_resources:
+        _cos_resources[key] = boto3.resource("s3",
+                                             endpoint_url=params["aws_endpoint_url"],
+                                             aws_access_key_id=params["aws_access_key_id"],
+                                             aws_secret_access_key=params["aws_secret_access_key"])
+    return _cos_resources[key]
+
+
+def get_http_session():
+    global _http_session
+    if _http_session is None:
+        _http_session = requests.Session()
+    return _http_session
 
 
 def run_safe(args):
     try:
-        import boto3
-        import traceback
-        import zipfile
-        from ruamel.yaml import YAML
-
         yaml = YAML()
 
         script_file = "fairness_check.py"
@@ -19,13 +42,6 @@ def run_safe(args):
         def create_model_zip():
             zipfile.ZipFile(archive_file, mode='w').write(script_file)
 
-        def create_cos_connection(params):
-            cos = boto3.resource("s3",
-                                 endpoint_url=params["aws_endpoint_url"],
-                                 aws_access_key_id=params["aws_access_key_id"],
-                                 aws_secret_access_key=params["aws_secret_access_key"])
-            return cos
-
         def get_or_create_bucket(cos, bucket_name):
             bucket = cos.Bucket(bucket_name)
             if not bucket.creation_date:
@@ -42,18 +58,33 @@ def run_safe(args):
             if source_bucket != target_bucket or source_file != target_file:
                 target_bucket.copy({"Bucket": source_bucket.name, "Key": source_file}, target_file)
 
+        def object_exists(bucket, key):
+            try:
+                bucket.Object(key).load()
+                return True
+            except boto3.exceptions.botocore.client.ClientError as e:
+                if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                    return False
+                raise
+
         def copy_training_result_files(cos, params):
             model_id = params["model_id"]
             tdb = get_or_create_bucket(cos, params["training_data_bucket"])
             trb = get_or_create_bucket(cos, params["training_results_bucket"])
             fcb = get_or_create_bucket(cos, get_data_bucket_name(params))  # fairness-check data bucket
+            if object_exists(trb, "%s/labels.npz" % model_id):
+                copy_file(trb, "%s/labels.npz" % model_id, fcb, "labels.npz")
+                return
+            # fall back to the text files written by older versions of the training script, and remove
+            # the labels.npz of a previous check which the fairness check script would read instead
+            fcb.Object("labels.npz").delete()
             for out_file in ["y_test.out", "p_test.out", "y_pred.out"]:
                 src_path = "%s/%s" % (model_id, out_file)
                 copy_file(trb, src_path, fcb, out_file)
 
         def create_manifest(params):
+            # the fairness metrics are computed with NumPy, AIF360 is only needed for "--engine aif360"
             training_command = "\
-                pip install aif360 pandas; \
                 python -u fairness_check.py --label_dir $DATA_DIR --model_dir $DATA_DIR/model.pt"
 
             manifest_dict = {
@@ -97,10 +128,10 @@ def run_safe(args):
                        "X-Watson-Userinfo": params["watson_auth_token"]}
             files = {'manifest': open('manifest.yml', 'rb'),
                      'model_definition': open('model.zip', 'rb')}
-            response = requests.post(url, headers=headers, files=files)
+            response = get_http_session().post(url, headers=headers, files=files)
             return json.loads(response.text or response.content or "{}")
 
-        cos = create_cos_connection(args)
+        cos = get_cos_resource(args)
         get_or_create_bucket(cos, get_data_bucket_name(args))
         get_or_create_bucket(cos, get_result_bucket_name(args))
         create_model_zip()
@@ -1,13 +1,19 @@
-from aif360.datasets import BinaryLabelDataset
-from aif360.metrics import ClassificationMetric
 import numpy as np
 import argparse
-import pandas as pd
+import itertools
+import os
+import re
+import sys
+import warnings
 
 
 def dataset_wrapper(outcome, protected, unprivileged_groups, privileged_groups, favorable_label, unfavorable_label):
     """ A wrapper function to create aif360 dataset from outcome and protected in numpy array format.
     """
+    # only import AIF360 (and pandas) if we need to, importing them takes seconds
+    import pandas as pd
+    from aif360.datasets import BinaryLabelDataset
+
     df = pd.DataFrame(data=outcome,
                       columns=['outcome'])
     df['race'] = protected
@@ -21,33 +27,399 @@ def dataset_wrapper(outcome, protected, unprivileged_groups, privileged_groups,
     return dataset
 
 
-if __name__ == "__main__":
+def get_label_file(label_dir, file_name, label_files=None):
+    """ The path of a label file in label_dir, or its file object (e.g. io.BytesIO) from the label_files
+        dict if given. Returns None if the file does not exist.
+    """
+    if label_files is not None:
+        label_file = label_files.get(file_name)
+        if label_file is not None:
+            label_file.seek(0)
+        return label_file
+    label_file = os.path.join(label_dir, file_name)
+    return label_file if os.path.exists(label_file) else None
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--label_dir', type=str, help='Label directory path')
-    parser.add_argument('--model_dir', type=str, help='Dataset directory path')
-    args = parser.parse_args()
 
-    label_dir = args.label_dir
-    model_dir = args.model_dir
+def load_labels(label_dir, label_files=None):
+    """ Load the test labels, protected features and predictions from labels.npz, or from the
+        text files written by older versions of the training script.
+    """
+    labels_file = get_label_file(label_dir, 'labels.npz', label_files)
+    if labels_file is not None:
+        with np.load(labels_file) as f:
+            return f['y_test'], f['p_test'], f['y_pred']
+    y_test = np.loadtxt(get_label_file(label_dir, 'y_test.out', label_files))
+    p_test = np.loadtxt(get_label_file(label_dir, 'p_test.out', label_files))
+    y_pred = np.loadtxt(get_label_file(label_dir, 'y_pred.out', label_files))
+    return y_test, p_test, y_pred
 
-    """Need to generalize the protected features"""
 
-    # races_to_consider = [0,4]
-    unprivileged_groups = [{'race': 4.0}]
-    privileged_groups = [{'race': 0.0}]
-    favorable_label = 0.0
-    unfavorable_label = 1.0
+def load_age(label_dir, label_files=None):
+    """ Load the ages of the test samples, only labels.npz of newer training jobs contain them.
+    """
+    labels_file = get_label_file(label_dir, 'labels.npz', label_files)
+    if labels_file is not None:
+        with np.load(labels_file) as f:
+            if 'age_test' in f.files:
+                return f['age_test']
+    return None
 
-    """Load the necessary labels and protected features for fairness check"""
 
-    # y_train = np.loadtxt(label_dir + '/y_train.out')
-    # p_train = np.loadtxt(label_dir + '/p_train.out')
-    y_test = np.loadtxt(label_dir + '/y_test.out')
-    p_test = np.loadtxt(label_dir + '/p_test.out')
-    y_pred = np.loadtxt(label_dir + '/y_pred.out')
+def get_age_buckets(age, bins=(20, 40, 60)):
+    """ Map ages to bucket names, e.g. '0-19', '20-39', '40-59' and '60+' for the default bins.
+    """
+    bins = list(bins)
+    names = ["%d-%d" % (lower, upper - 1) for lower, upper in zip([0] + bins[:-1], bins)] + ["%d+" % bins[-1]]
+    return np.array(names)[np.digitize(age, bins)]
+
+
+# how the privileged group of a pair is chosen when no group pairs are given, reported with the group metrics
+group_order_convention = "privileged is the group with the lower attribute values, compared attribute by attribute, " \
+                         "with age buckets ordered numerically by their lower bound"
+
+
+def get_value_order(value):
+    """ Sort key of an attribute value, ordering age buckets like '20-39' and '100+' numerically by their
+        lower bound instead of as strings.
+    """
+    if isinstance(value, str):
+        match = re.match(r"(\d+)(-\d+|\+)$", value)
+        if match:
+            return int(match.group(1)), value
+    return value
+
+
+def get_group_mask(attributes, group_definitions):
+    """ Select the samples of a group, defined like in AIF360 as a list of dicts which are OR'ed,
+        with the conditions of each dict AND'ed, e.g. [{'race': 4.0}].
+    """
+    num_samples = len(next(iter(attributes.values())))
+    mask = np.zeros(num_samples, dtype=bool)
+    for group_definition in group_definitions:
+        group_mask = np.ones(num_samples, dtype=bool)
+        for name, value in group_definition.items():
+            group_mask &= (attributes[name] == value)
+        mask |= group_mask
+    return mask
+
+
+def get_confusion_codes(y_true, y_pred, groups, favorable_label):
+    """ Encode group, true and predicted label of each sample as one integer 4 * group + 2 * t + p,
+        with t and p being 1 if the true and predicted label are the favorable one.
+    """
+    return 4 * np.asarray(groups, dtype=np.intp) \
+        + 2 * (np.asarray(y_true) == favorable_label) \
+        + (np.asarray(y_pred) == favorable_label)
+
+
+def get_confusion_matrices(y_true, y_pred, groups, num_groups, favorable_label):
+    """ Count the confusion matrices of all groups in a single bincount pass.
+
+        Returns an int array of shape (num_groups, 2, 2) indexed by
+        [group, true label is favorable, predicted label is favorable].
+    """
+    codes = get_confusion_codes(y_true, y_pred, groups, favorable_label)
+    return np.bincount(codes, minlength=4 * num_groups).reshape(num_groups, 2, 2)
+
+
+def get_bootstrap_confusion_matrices(y_true, y_pred, groups, num_groups, favorable_label, num_resamples,
+                                     seed=None, max_batch_bytes=2 ** 25):
+    """ Count the confusion matrices of all groups for num_resamples bootstrap resamples at once.
+
+        The resamples are drawn as one index matrix and counted with a single bincount per batch, offsetting
+        the codes of each resample by 4 * num_groups. The batches are sized so the index matrix and the
+        resampled codes (8 bytes per element each) stay within max_batch_bytes, 32MB by default.
+        Returns an int array of shape (num_resamples, num_groups, 2, 2).
+    """
+    codes = get_confusion_codes(y_true, y_pred, groups, favorable_label)
+    num_samples = len(codes)
+    num_codes = 4 * num_groups
+    random_state = np.random.RandomState(seed)
+    batch_size = max(1, max_batch_bytes // (16 * max(1, num_samples)))
+    counts = np.empty((num_resamples, num_codes), dtype=np.int64)
+    for start in range(0, num_resamples, batch_size):
+        size = min(batch_size, num_resamples - start)
+        indices = random_state.randint(0, num_samples, size=(size, num_samples))
+        resampled_codes = codes[indices]
+        del indices
+        resampled_codes += num_codes * np.arange(size)[:, np.newaxis]
+        counts[start:start + size] = np.bincount(resampled_codes.ravel(), minlength=size * num_codes)\
+            .reshape(size, num_codes)
+    return counts.reshape(num_resamples, num_groups, 2, 2)
+
+
+def get_confidence_intervals(metrics, confidence=0.95):
+    """ Percentile intervals of bootstrapped metrics, the resamples being the first dimension.
+    """
+    percentiles = [50.0 * (1.0 - confidence), 50.0 * (1.0 + confidence)]
+    with warnings.catch_warnings():
+        # metrics which are NaN in all resamples (e.g. empty groups) have NaN intervals
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return dict((name, np.nanpercentile(value, percentiles, axis=0)) for name, value in metrics.items())
+
+
+def get_rates(cm):
+    """ The rates of a confusion matrix of shape (..., 2, 2), the favorable label being the positive one.
+    """
+    tn, fp, fn, tp = cm[..., 0, 0], cm[..., 0, 1], cm[..., 1, 0], cm[..., 1, 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {
+            "TPR": tp / (tp + fn),
+            "TNR": tn / (tn + fp),
+            "FPR": fp / (fp + tn),
+            "FNR": fn / (tp + fn),
+            "selection_rate": (tp + fp) / (tn + fp + fn + tp),
+            "accuracy": (tp + tn) / (tn + fp + fn + tp)
+        }
+
+
+def get_theil_index(cm):
+    """ The Theil index of the benefits b = y_pred - y_true + 1, which are 1 for correct predictions,
+        2 for false positives and 0 for false negatives, computed from a confusion matrix (..., 2, 2).
+    """
+    num_correct = cm[..., 0, 0] + cm[..., 1, 1]
+    num_fp = cm[..., 0, 1]
+    n = cm.sum(axis=(-2, -1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mu = (num_correct + 2.0 * num_fp) / n
+        # 0 * log(0) is 0 for the false negatives, and for groups without false positives
+        theil_fp = np.where(num_fp > 0, num_fp * (2.0 / mu) * np.log(2.0 / mu), 0.0)
+        return (num_correct * (1.0 / mu) * np.log(1.0 / mu) + theil_fp) / n
+
+
+def get_metrics(cm_all, cm_privileged, cm_unprivileged):
+    """ Compute the fairness metrics from the confusion matrices of all samples, the privileged and the
+        unprivileged group. The confusion matrices can have leading dimensions, e.g. for bootstrap samples.
+    """
+    rates = get_rates(cm_all)
+    privileged = get_rates(cm_privileged)
+    unprivileged = get_rates(cm_unprivileged)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {
+            "Classification accuracy": rates["accuracy"],
+            "Balanced classification accuracy": 0.5 * (rates["TPR"] + rates["TNR"]),
+            "Statistical parity difference": unprivileged["selection_rate"] - privileged["selection_rate"],
+            "Disparate impact": unprivileged["selection_rate"] / privileged["selection_rate"],
+            "Equal opportunity difference": unprivileged["TPR"] - privileged["TPR"],
+            "Average odds difference": 0.5 * ((unprivileged["FPR"] - privileged["FPR"])
+                                              + (unprivileged["TPR"] - privileged["TPR"])),
+            "Theil index": get_theil_index(cm_all),
+            "False negative rate difference": unprivileged["FNR"] - privileged["FNR"]
+        }
+
+
+def get_fairness_metrics(y_test, p_test, y_pred, unprivileged_groups, privileged_groups, favorable_label,
+                         bootstrap=0, confidence=0.95, seed=None):
+    """ Compute the fairness metrics with NumPy, from one grouped confusion matrix count, and their
+        bootstrap confidence intervals for bootstrap > 0 resamples.
+    """
+    attributes = {'race': np.asarray(p_test)}
+    # group 0: privileged, group 1: unprivileged, group 2: neither
+    groups = np.full(len(p_test), 2, dtype=np.intp)
+    groups[get_group_mask(attributes, unprivileged_groups)] = 1
+    groups[get_group_mask(attributes, privileged_groups)] = 0
+    cm = get_confusion_matrices(y_test, y_pred, groups, 3, favorable_label)
+    metrics = get_metrics(cm.sum(axis=0), cm[0], cm[1])
+    metrics = dict((name, float(value)) for name, value in metrics.items())
+    if not bootstrap:
+        return metrics, None
+    cm = get_bootstrap_confusion_matrices(y_test, y_pred, groups, 3, favorable_label, bootstrap, seed)
+    intervals = get_confidence_intervals(get_metrics(cm.sum(axis=1), cm[:, 0], cm[:, 1]), confidence)
+    return metrics, dict((name, [float(low), float(high)]) for name, (low, high) in intervals.items())
+
+
+def to_json_value(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def get_group_pair_confusion_matrices(cm, names, values, group_pairs=None):
+    """ Sum up the confusion matrices of the groups to compare from the confusion matrices of all
+        intersections of attribute values, cm having the shape (..., num_values_1, ..., num_values_k, 2, 2).
+
+        Returns the privileged and unprivileged confusion matrices, each of shape (..., num_pairs, 2, 2),
+        and the (unprivileged_groups, privileged_groups) definitions of the pairs.
+    """
+    num_leading = cm.ndim - len(names) - 2
+    leading_shape = cm.shape[:num_leading]
+    unprivileged_cms, privileged_cms, descriptions = [], [], []
+    if group_pairs:
+        # evaluate the group definitions on the grid of attribute values instead of on every sample
+        grid = dict(zip(names, [g.ravel() for g in np.meshgrid(*values, indexing='ij')]))
+        cells_cm = cm.reshape(leading_shape + (-1, 2, 2))
+        for group_pair in group_pairs:
+            unprivileged_groups = group_pair["unprivileged_groups"]
+            privileged_groups = group_pair["privileged_groups"]
+            unprivileged_cms.append(cells_cm[..., get_group_mask(grid, unprivileged_groups), :, :].sum(axis=-3))
+            privileged_cms.append(cells_cm[..., get_group_mask(grid, privileged_groups), :, :].sum(axis=-3))
+            descriptions.append((unprivileged_groups, privileged_groups))
+    else:
+        for num_attributes in range(1, len(names) + 1):
+            for axes in itertools.combinations(range(len(names)), num_attributes):
+                other_axes = tuple(num_leading + axis for axis in range(len(names)) if axis not in axes)
+                slice_cm = cm.sum(axis=other_axes).reshape(leading_shape + (-1, 2, 2))
+                group_values = list(itertools.product(*[values[axis] for axis in axes]))
+                groups = [dict((names[axis], to_json_value(value)) for axis, value in zip(axes, group_value))
+                          for group_value in group_values]
+                # the group earlier in numerical order is the privileged one of a pair
+                order = sorted(range(len(groups)), key=lambda k: [get_value_order(to_json_value(value))
+                                                                  for value in group_values[k]])
+                for i, j in itertools.combinations(order, 2):
+                    unprivileged_cms.append(slice_cm[..., j, :, :])
+                    privileged_cms.append(slice_cm[..., i, :, :])
+                    descriptions.append(([groups[j]], [groups[i]]))
+    if not descriptions:
+        return None, None, []
+    return np.stack(privileged_cms, axis=-3), np.stack(unprivileged_cms, axis=-3), descriptions
+
+
+def get_group_fairness_metrics(y_true, y_pred, attributes, favorable_label, group_pairs=None,
+                               bootstrap=0, confidence=0.95, seed=None):
+    """ Compute the fairness metrics for many groups from a single confusion matrix tensor of all
+        intersections of the protected attributes, e.g. race x age bucket.
+
+        attributes: dict of protected attribute name -> array of values per sample
+        group_pairs: list of dicts with AIF360 style "unprivileged_groups" and "privileged_groups".
+            Without group pairs, every pair of groups of every attribute and every intersection of
+            attributes is compared once, following group_order_convention.
+        bootstrap: number of bootstrap resamples to compute confidence intervals from, 0 for none
+    """
+    names = list(attributes)
+    values, codes = zip(*[np.unique(attributes[name], return_inverse=True) for name in names])
+    shape = tuple(len(v) for v in values)
+    cells = np.ravel_multi_index([c.ravel() for c in codes], shape)
+    num_cells = int(np.prod(shape))
+    cm = get_confusion_matrices(y_true, y_pred, cells, num_cells, favorable_label)
+    bootstrap_cm = None
+    if bootstrap:
+        bootstrap_cm = get_bootstrap_confusion_matrices(y_true, y_pred, cells, num_cells, favorable_label,
+                                                        bootstrap, seed).reshape((bootstrap,) + shape + (2, 2))
+    return get_group_metrics_from_tensor(cm.reshape(shape + (2, 2)), names, values, group_pairs,
+                                         bootstrap_cm, confidence)
 
-    """Calculate the fairness metrics"""
+
+def get_group_metrics_from_tensor(cm, names, values, group_pairs=None, bootstrap_cm=None, confidence=0.95):
+    """ The fairness metrics of all (or the given) pairs of groups from the confusion matrix tensor cm of shape
+        (num_values_1, ..., num_values_k, 2, 2) of all intersections of the attribute values, used for both
+        in-memory and accumulated predictions. Optionally with confidence intervals from a tensor bootstrap_cm
+        of the same shape with a leading resample dimension.
+    """
+    cm_privileged, cm_unprivileged, descriptions = get_group_pair_confusion_matrices(cm, names, values, group_pairs)
+    if not descriptions:
+        return []
+    cm_all = cm.reshape(-1, 2, 2).sum(axis=0)
+    metrics = get_metrics(cm_all, cm_privileged, cm_unprivileged)
+    metrics = dict((name, np.broadcast_to(value, (len(descriptions),))) for name, value in metrics.items())
+    results = [{
+        "unprivileged_groups": unprivileged_groups,
+        "privileged_groups": privileged_groups,
+        "metrics": dict((name, float(value[k])) for name, value in metrics.items())
+    } for k, (unprivileged_groups, privileged_groups) in enumerate(descriptions)]
+
+    if bootstrap_cm is not None:
+        num_resamples = bootstrap_cm.shape[0]
+        cm_privileged, cm_unprivileged, _ = \
+            get_group_pair_confusion_matrices(bootstrap_cm, names, values, group_pairs)
+        cm_all = bootstrap_cm.reshape(num_resamples, -1, 2, 2).sum(axis=1)[:, np.newaxis]
+        metrics = get_metrics(cm_all, cm_privileged, cm_unprivileged)
+        metrics = dict((name, np.broadcast_to(value, (num_resamples, len(descriptions))))
+                       for name, value in metrics.items())
+        intervals = get_confidence_intervals(metrics, confidence)
+        for k, result in enumerate(results):
+            result["confidence_intervals"] = dict((name, [float(interval[0, k]), float(interval[1, k])])
+                                                  for name, interval in intervals.items())
+    return results
+
+
+class FairnessMetricsAccumulator(object):
+    """ Accumulates the confusion matrices of all intersections of the protected attribute values over
+        shards of predictions, so the metrics of data sets which do not fit into memory can be computed.
+        Accumulators of different workers can be merged, they are picklable and convertible to JSON.
+    """
+    def __init__(self, unprivileged_groups, privileged_groups, favorable_label):
+        self.unprivileged_groups = unprivileged_groups
+        self.privileged_groups = privileged_groups
+        self.favorable_label = favorable_label
+        self.attribute_names = None
+        # tuple of attribute values -> confusion matrix (2, 2)
+        self.confusion_matrices = dict()
+
+    def update(self, y_true, y_pred, attributes):
+        """ Add a shard of true labels, predictions and a dict of protected attribute arrays.
+        """
+        names = list(attributes)
+        if self.attribute_names is None:
+            self.attribute_names = names
+        elif sorted(names) != sorted(self.attribute_names):
+            raise ValueError("Expected the attributes %s, got %s" % (self.attribute_names, names))
+        values, codes = zip(*[np.unique(attributes[name], return_inverse=True) for name in self.attribute_names])
+        shape = tuple(len(v) for v in values)
+        cells = np.ravel_multi_index([c.ravel() for c in codes], shape)
+        cm = get_confusion_matrices(y_true, y_pred, cells, int(np.prod(shape)), self.favorable_label)
+        for cell in np.flatnonzero(cm.sum(axis=(1, 2))):
+            key = tuple(to_json_value(values[axis][index])
+                        for axis, index in enumerate(np.unravel_index(cell, shape)))
+            self.confusion_matrices[key] = self.confusion_matrices.get(key, 0) + cm[cell]
+        return self
+
+    def merge(self, other):
+        """ Add the confusion matrices accumulated by another accumulator, e.g. of another worker.
+        """
+        if other.attribute_names is None:
+            return self
+        if self.attribute_names is None:
+            self.attribute_names = list(other.attribute_names)
+        elif sorted(other.attribute_names) != sorted(self.attribute_names):
+            raise ValueError("Expected the attributes %s, got %s" % (self.attribute_names, other.attribute_names))
+        order = [other.attribute_names.index(name) for name in self.attribute_names]
+        for key, cm in other.confusion_matrices.items():
+            key = tuple(key[index] for index in order)
+            self.confusion_matrices[key] = self.confusion_matrices.get(key, 0) + np.asarray(cm)
+        return self
+
+    def to_json(self):
+        return {
+            "attribute_names": self.attribute_names,
+            "confusion_matrices": [[list(key), np.asarray(cm).tolist()] for key, cm in self.confusion_matrices.items()]
+        }
+
+    def merge_json(self, data):
+        other = FairnessMetricsAccumulator(self.unprivileged_groups, self.privileged_groups, self.favorable_label)
+        other.attribute_names = data["attribute_names"]
+        other.confusion_matrices = dict((tuple(key), np.array(cm)) for key, cm in data["confusion_matrices"])
+        return self.merge(other)
+
+    def get_confusion_tensor(self):
+        """ The accumulated confusion matrices as tensor (num_values_1, ..., num_values_k, 2, 2).
+        """
+        values = [np.unique([key[axis] for key in self.confusion_matrices]) for axis in range(len(self.attribute_names))]
+        cm = np.zeros(tuple(len(v) for v in values) + (2, 2), dtype=np.int64)
+        for key, key_cm in self.confusion_matrices.items():
+            cm[tuple(int(np.searchsorted(v, value)) for v, value in zip(values, key))] += key_cm
+        return cm, values
+
+    def get_metrics(self, intersectional=False, group_pairs=None):
+        """ The fairness metrics of the privileged and unprivileged groups, and optionally of all (or the given)
+            pairs of groups and intersections like get_group_fairness_metrics.
+        """
+        if not self.confusion_matrices:
+            raise ValueError("No predictions were accumulated")
+        cm, values = self.get_confusion_tensor()
+        names = self.attribute_names
+        group_pair = {"unprivileged_groups": self.unprivileged_groups, "privileged_groups": self.privileged_groups}
+        result = {"metrics": get_group_metrics_from_tensor(cm, names, values, [group_pair])[0]["metrics"]}
+        if not intersectional and not group_pairs:
+            return result
+        result["group_metrics"] = get_group_metrics_from_tensor(cm, names, values, group_pairs)
+        if not group_pairs:
+            result["group_order_convention"] = group_order_convention
+        return result
+
+
+def get_fairness_metrics_aif360(y_test, p_test, y_pred, unprivileged_groups, privileged_groups,
+                                favorable_label, unfavorable_label):
+    """ Compute the fairness metrics with AIF360.
+    """
+    from aif360.metrics import ClassificationMetric
 
     # original_traning_dataset = dataset_wrapper(outcome=y_train, protected=p_train,
     #                                            unprivileged_groups=unprivileged_groups,
@@ -73,16 +445,6 @@ if __name__ == "__main__":
     TNR = classified_metric_nodebiasing_test.true_negative_rate()
     bal_acc_nodebiasing_test = 0.5*(TPR+TNR)
 
-    print("#### Plain model - without debiasing - classification metrics on test set")
-    # print("Test set: Classification accuracy = %f" % classified_metric_nodebiasing_test.accuracy())
-    # print("Test set: Balanced classification accuracy = %f" % bal_acc_nodebiasing_test)
-    # print("Test set: Statistical parity difference = %f" % classified_metric_nodebiasing_test.statistical_parity_difference())
-    # print("Test set: Disparate impact = %f" % classified_metric_nodebiasing_test.disparate_impact())
-    # print("Test set: Equal opportunity difference = %f" % classified_metric_nodebiasing_test.equal_opportunity_difference())
-    # print("Test set: Average odds difference = %f" % classified_metric_nodebiasing_test.average_odds_difference())
-    # print("Test set: Theil index = %f" % classified_metric_nodebiasing_test.theil_index())
-    # print("Test set: False negative rate difference = %f" % classified_metric_nodebiasing_test.false_negative_rate_difference())
-
     metrics = {
         "Classification accuracy": classified_metric_nodebiasing_test.accuracy(),
         "Balanced classification accuracy": bal_acc_nodebiasing_test,
@@ -93,4 +455,125 @@ if __name__ == "__main__":
         "Theil index": classified_metric_nodebiasing_test.theil_index(),
         "False negative rate difference": classified_metric_nodebiasing_test.false_negative_rate_difference()
     }
-    print("metrics: ", metrics)
+    return metrics
+
+
+def compare_metrics(metrics, expected_metrics):
+    """ Return the names of the metrics which differ from the expected ones (NaN equal to NaN).
+    """
+    return [name for name, value in expected_metrics.items()
+            if not np.isclose(metrics[name], value, rtol=1e-9, atol=1e-12, equal_nan=True)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--label_dir', type=str, default=".", help='Label directory path')
+    parser.add_argument('--model_dir', type=str, default=".", help='Dataset directory path')
+    parser.add_argument('--engine', type=str, choices=['numpy', 'aif360'], default='numpy',
+                        help='Compute the metrics with NumPy or with AIF360')
+    parser.add_argument('--validate', action='store_true',
+                        help='Validate the metrics computed with NumPy against the ones computed with AIF360')
+    parser.add_argument('--intersectional', action='store_true',
+                        help='Also compare all groups of race, age bucket and race x age bucket')
+    parser.add_argument('--age_bins', type=str, default="20,40,60", help='Comma separated age bucket boundaries')
+    parser.add_argument('--bootstrap', type=int, default=0,
+                        help='Number of bootstrap resamples to compute confidence intervals from')
+    parser.add_argument('--confidence', type=float, default=0.95, help='Confidence level of the bootstrap intervals')
+    parser.add_argument('--seed', type=int, help='Random seed of the bootstrap resamples')
+    parser.add_argument('--label_files', type=str, nargs='+',
+                        help='Shards of labels (npz files like labels.npz) to accumulate the metrics over one by one')
+    args = parser.parse_args()
+
+    label_dir = args.label_dir
+    model_dir = args.model_dir
+
+    if args.validate:
+        metrics = fairness_check(label_dir, model_dir, engine='numpy')["metrics"]
+        expected_metrics = fairness_check(label_dir, model_dir, engine='aif360')["metrics"]
+        differences = compare_metrics(metrics, expected_metrics)
+        for name in differences:
+            print("%s: numpy %s != aif360 %s" % (name, metrics[name], expected_metrics[name]))
+        print("validation %s" % ("failed" if differences else "passed"))
+        sys.exit(1 if differences else 0)
+
+    age_bins = [int(age) for age in args.age_bins.split(",")]
+
+    if args.label_files:
+        print("metrics: %s" % fairness_check_shards(args.label_files, intersectional=args.intersectional,
+                                                    age_bins=age_bins))
+        return
+
+    print("metrics: %s" % fairness_check(label_dir, model_dir, engine=args.engine,
+                                         intersectional=args.intersectional, age_bins=age_bins,
+                                         bootstrap=args.bootstrap, confidence=args.confidence, seed=args.seed))
+
+
+def fairness_check(label_dir, model_dir, engine='numpy', intersectional=False, group_pairs=None,
+                   age_bins=(20, 40, 60), bootstrap=0, confidence=0.95, seed=None, label_files=None):
+    """Need to generalize the protected features"""
+
+    if engine == 'aif360' and bootstrap:
+        raise ValueError("Bootstrap confidence intervals are only computed by the numpy engine")
+
+    # races_to_consider = [0,4]
+    unprivileged_groups = [{'race': 4.0}]
+    privileged_groups = [{'race': 0.0}]
+    favorable_label = 0.0
+    unfavorable_label = 1.0
+
+    """Load the necessary labels and protected features for fairness check"""
+
+    # y_train = np.loadtxt(label_dir + '/y_train.out')
+    # p_train = np.loadtxt(label_dir + '/p_train.out')
+    y_test, p_test, y_pred = load_labels(label_dir, label_files)
+
+    """Calculate the fairness metrics"""
+
+    print("#### Plain model - without debiasing - classification metrics on test set")
+
+    result = dict()
+    if engine == 'aif360':
+        result["metrics"] = get_fairness_metrics_aif360(y_test, p_test, y_pred, unprivileged_groups,
+                                                        privileged_groups, favorable_label, unfavorable_label)
+    else:
+        result["metrics"], confidence_intervals = \
+            get_fairness_metrics(y_test, p_test, y_pred, unprivileged_groups, privileged_groups, favorable_label,
+                                 bootstrap=bootstrap, confidence=confidence, seed=seed)
+        if confidence_intervals:
+            result["confidence_intervals"] = confidence_intervals
+
+    if not intersectional and not group_pairs:
+        return result
+
+    """Calculate the fairness metrics of all (or the given) pairs of groups and intersections"""
+
+    attributes = {'race': p_test}
+    age_test = load_age(label_dir, label_files)
+    if age_test is not None:
+        attributes['age'] = get_age_buckets(age_test, age_bins)
+    result["group_metrics"] = get_group_fairness_metrics(y_test, y_pred, attributes, favorable_label, group_pairs,
+                                                         bootstrap=bootstrap, confidence=confidence, seed=seed)
+    if not group_pairs:
+        result["group_order_convention"] = group_order_convention
+    return result
+
+
+def fairness_check_shards(label_files, intersectional=False, group_pairs=None, age_bins=(20, 40, 60)):
+    """ Compute the fairness metrics over shards of labels, loading only one shard into memory at a time.
+    """
+    unprivileged_groups = [{'race': 4.0}]
+    privileged_groups = [{'race': 0.0}]
+    favorable_label = 0.0
+
+    accumulator = FairnessMetricsAccumulator(unprivileged_groups, privileged_groups, favorable_label)
+    for label_file in label_files:
+        with np.load(label_file) as f:
+            attributes = {'race': f['p_test']}
+            if (intersectional or group_pairs) and 'age_test' in f.files:
+                attributes['age'] = get_age_buckets(f['age_test'], age_bins)
+            accumulator.update(f['y_test'], f['y_pred'], attributes)
+    return accumulator.get_metrics(intersectional=intersectional, group_pairs=group_pairs)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,191 @@
 # OpenWhisk action to poll the status of a FfDL training job
 
+import os
+import random
+import requests
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
-def run_safe(params):
-    try:
-        import requests
-        url = "%s/v1/models/%s?version=2017-02-13" % (params["ffdl_service_url"], params["training_id"])
-        headers = {
-            "Accept": "application/json",
-            "Authorization": params["basic_authtoken"],
-            "X-Watson-Userinfo": params["watson_auth_token"]
+# maximum number of training status requests sent concurrently for a list of training IDs
+max_concurrent_requests = 16
+
+# training job states after which the status will not change anymore
+terminal_states = ["COMPLETED", "FAILED", "HALTED", "NOT FOUND"]
+
+# backoff between polls in "wait_for" mode, in seconds
+initial_poll_interval = 1.0
+max_poll_interval = 30.0
+
+# default time to wait for terminal states, and the time to leave before the action deadline, in seconds
+default_wait_timeout = 55.0
+deadline_margin = 5.0
+
+# timeout of a single status request, and the least time left before the deadline to start another poll, in seconds
+request_timeout = 10.0
+min_poll_time = 1.0
+
+# number of consecutive failed polls after which a training ID is no longer polled in "wait_for" mode
+max_poll_errors = 3
+
+# keep-alive connections survive in warm containers
+_http_session = None
+
+
+def get_http_session():
+    global _http_session
+    if _http_session is None:
+        _http_session = requests.Session()
+        # keep one pooled connection per concurrent request to the FfDL service
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrent_requests)
+        _http_session.mount("http://", adapter)
+        _http_session.mount("https://", adapter)
+    return _http_session
+
+
+def get_error_result(e, retryable=False):
+    return {
+        "Status": "Error",
+        "Retryable": retryable,
+        "Details": {
+            e.__class__.__name__: str(e),
+            "Trace": traceback.format_exc()
         }
-        response = requests.get(url, headers=headers, timeout=10)
-        if response.status_code == 404:
-            return {
-                "status": "NOT FOUND",
-                "training_id": params['training_id'],
-                "request": url,
-                "response": response.json()
-            }
-        result = response.json()  # json.loads(response.text or response.content or "{}")
+    }
+
+
+def get_training_status(params, training_id, timeout=request_timeout):
+    url = "%s/v1/models/%s?version=2017-02-13" % (params["ffdl_service_url"], training_id)
+    headers = {
+        "Accept": "application/json",
+        "Authorization": params["basic_authtoken"],
+        "X-Watson-Userinfo": params["watson_auth_token"]
+    }
+    response = get_http_session().get(url, headers=headers, timeout=timeout)
+    if response.status_code >= 500:
+        # server errors are raised as HTTPError (a RequestException), so they are retried
+        response.raise_for_status()
+    if response.status_code == 404:
         return {
-            "training_id": result['model_id'],
-            "status": result['training']['training_status']['status'],
-            "model_name": result['name']
+            "status": "NOT FOUND",
+            "training_id": training_id,
+            "request": url,
+            "response": response.json()
         }
+    result = response.json()  # json.loads(response.text or response.content or "{}")
+    return {
+        "training_id": result['model_id'],
+        "status": result['training']['training_status']['status'],
+        "model_name": result['name']
+    }
+
 
+def get_training_status_safe(params, training_id, timeout=request_timeout):
+    # report errors per training ID so one failing request does not fail the whole batch,
+    # only connection errors, timeouts and server errors are worth retrying, not e.g. an unexpected payload
+    try:
+        return get_training_status(params, training_id, timeout)
+    except requests.exceptions.RequestException as e:
+        return get_error_result(e, retryable=True)
     except Exception as e:
-        import traceback
-        return {
-            "Status": "Error",
-            "Details": {
-                e.__class__.__name__: str(e),
-                "Trace": traceback.format_exc()
+        return get_error_result(e)
+
+
+def get_training_status_map(params, training_ids, timeout=None):
+    # with a timeout (in seconds) for all requests, every request gets an equal share of it: the requests run
+    # in rounds of max_concurrent_requests, each of which can take the connect plus the read timeout
+    max_workers = max(1, min(len(training_ids), max_concurrent_requests))
+    num_rounds = -(-len(training_ids) // max_workers)
+    request_time = request_timeout if timeout is None else min(request_timeout, timeout / (2.0 * num_rounds))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(lambda training_id: get_training_status_safe(params, training_id, request_time),
+                               training_ids)
+        return dict(zip(training_ids, results))
+
+
+def is_terminal(result, num_errors=0):
+    if result.get("Status") == "Error":
+        return not result.get("Retryable") or num_errors >= max_poll_errors
+    return result.get("status") in terminal_states
+
+
+def get_wait_deadline(params):
+    deadline = time.time() + float(params.get("wait_timeout", default_wait_timeout))
+    # OpenWhisk sets the absolute action deadline in milliseconds since epoch
+    action_deadline = os.environ.get("__OW_DEADLINE")
+    if action_deadline:
+        deadline = min(deadline, int(action_deadline) / 1000.0 - deadline_margin)
+    return deadline
+
+
+def wait_for_training_status_map(params, training_ids):
+    # poll the training jobs which did not reach a terminal state yet, with exponential backoff and
+    # jitter between polls, until all are terminal or the deadline (just before the action timeout) passed
+    start_time = time.time()
+    deadline = get_wait_deadline(params)
+    poll_interval = initial_poll_interval
+    statuses = dict((training_id, get_error_result(TimeoutError("No status received before the deadline"), True))
+                    for training_id in training_ids)
+    num_errors = dict.fromkeys(training_ids, 0)
+    pending_ids = training_ids
+    polls = 0
+    while True:
+        # a poll never runs past the deadline, its request timeouts are bounded by the remaining time
+        remaining_time = deadline - time.time()
+        if remaining_time < min_poll_time:
+            break
+        results = get_training_status_map(params, pending_ids, timeout=remaining_time)
+        polls += 1
+        for training_id, result in results.items():
+            statuses[training_id] = result
+            num_errors[training_id] = num_errors[training_id] + 1 if result.get("Status") == "Error" else 0
+        pending_ids = [training_id for training_id in pending_ids
+                       if not is_terminal(statuses[training_id], num_errors[training_id])]
+        remaining_time = deadline - time.time()
+        if not pending_ids or remaining_time < min_poll_time:
+            break
+        time.sleep(min(remaining_time - min_poll_time, poll_interval / 2 + random.uniform(0, poll_interval / 2)))
+        poll_interval = min(2 * poll_interval, max_poll_interval)
+    return statuses, time.time() - start_time, polls
+
+
+def parse_bool(value):
+    # parameters may be passed as JSON booleans or as strings, e.g. on the command line
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "yes", "1")
+    return bool(value)
+
+
+def run_safe(params):
+    try:
+        wait_for = parse_bool(params.get("wait_for", False))
+        if "training_ids" in params:
+            training_ids = params["training_ids"]
+            if isinstance(training_ids, str):
+                training_ids = [training_id.strip() for training_id in training_ids.split(",") if training_id.strip()]
+            training_ids = list(dict.fromkeys(training_ids))
+            if wait_for:
+                statuses, elapsed_time, polls = wait_for_training_status_map(params, training_ids)
+                return {
+                    "statuses": statuses,
+                    "elapsed_time": elapsed_time,
+                    "polls": polls
+                }
+            return {
+                "statuses": get_training_status_map(params, training_ids)
             }
-        }
+        if wait_for:
+            training_id = params["training_id"]
+            statuses, elapsed_time, polls = wait_for_training_status_map(params, [training_id])
+            result = statuses[training_id]
+            result["elapsed_time"] = elapsed_time
+            result["polls"] = polls
+            return result
+        return get_training_status(params, params["training_id"])
+
+    except Exception as e:
+        return get_error_result(e)
 
 
 # main() method will be run when this action gets invoked
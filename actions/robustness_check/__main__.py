@@ -1,15 +1,38 @@
 # OpenWhisk action to perform a model robustness check with ART on FfDL
 
-import json, requests
+import boto3
+import hashlib
+import json
+import requests
+import traceback
+import zipfile
+from ruamel.yaml import YAML
+
+# kept by warm containers
+_cos_resources = {}
+_http_session = None
+
+
+def get_cos_resource(params):
+    key = (params["aws_endpoint_url"], params["aws_access_key_id"],
+           hashlib.sha256(params["aws_secret_access_key"].encode()).hexdigest())
+    if key not in _cos_resources:
+        _cos_resources[key] = boto3.resource("s3",
+                                             endpoint_url=params["aws_endpoint_url"],
+                                             aws_access_key_id=params["aws_access_key_id"],
+                                             aws_secret_access_key=params["aws_secret_access_key"])
+    return _cos_resources[key]
+
+
+def get_http_session():
+    global _http_session
+    if _http_session is None:
+        _http_session = requests.Session()
+    return _http_session
 
 
 def run_safe(args):
     try:
-        import boto3
-        import traceback
-        import zipfile
-        from ruamel.yaml import YAML
-
         yaml = YAML()
 
         script_file = "robustness_check.py"
@@ -19,13 +42,6 @@ def run_safe(args):
         def create_model_zip():
             zipfile.ZipFile(archive_file, mode='w').write(script_file)
 
-        def create_cos_connection(params):
-            cos = boto3.resource("s3",
-                                 endpoint_url=params["aws_endpoint_url"],
-                                 aws_access_key_id=params["aws_access_key_id"],
-                                 aws_secret_access_key=params["aws_secret_access_key"])
-            return cos
-
         def get_or_create_bucket(cos, bucket_name):
             bucket = cos.Bucket(bucket_name)
             if not bucket.creation_date:
@@ -49,21 +65,54 @@ def run_safe(args):
             tdb = get_or_create_bucket(cos, params["training_data_bucket"])
             trb = get_or_create_bucket(cos, params["training_results_bucket"])
             rcb = get_or_create_bucket(cos, get_data_bucket_name(params))
-            copy_file(tdb, params["dataset_file"], rcb, params["dataset_file"])
+            if params["dataset_file"].endswith(".npz"):
+                copy_file(tdb, params["dataset_file"], rcb, params["dataset_file"])
+            else:
+                # memory-mappable data set, a directory of npy files of which only the test data is needed
+                for npy_file in ["x_test.npy", "y_test.npy"]:
+                    dataset_path = "%s/%s" % (params["dataset_file"], npy_file)
+                    copy_file(tdb, dataset_path, rcb, dataset_path)
             copy_file(trb, "%s/%s" % (model_id, params["networkdefinition_file"]), rcb, params["networkdefinition_file"])
             copy_file(trb, "%s/%s" % (model_id, params["weights_file"]), rcb, params["weights_file"])
 
+        def get_epsilon_args(params):
+            # a list of epsilons runs a sweep producing a robustness curve, reusing one gradient computation
+            epsilons = params.get("epsilons")
+            if epsilons:
+                if not isinstance(epsilons, str):
+                    epsilons = ",".join(str(epsilon) for epsilon in epsilons)
+                return "--epsilons %s" % epsilons
+            return "--epsilon %s" % params.get("epsilon", 0.2)
+
+        def get_shard_args(params):
+            # with multiple learners, the first one waits up to merge_timeout seconds for the others to merge
+            # their metrics, through the results bucket which all learners mount as RESULT_DIR
+            if int(params.get("learners", 1)) > 1:
+                return "--merge_timeout %d" % int(params.get("merge_timeout", 3600))
+            return ""
+
+        def get_sample_args(params):
+            # a quick check of a class-stratified random sample of the test set, with confidence intervals
+            if params.get("sample"):
+                return "--sample %d --seed %d" % (int(params["sample"]), int(params.get("seed", 0)))
+            if params.get("sample_fraction"):
+                return "--sample_fraction %s --seed %d" % (float(params["sample_fraction"]), int(params.get("seed", 0)))
+            return ""
+
         def create_manifest(params):
             training_command = "\
-                pip3 install keras; \
+                pip3 install keras h5py; \
                 pip3 install https://github.com/IBM/adversarial-robustness-toolbox/zipball/master; \
                 python3 robustness_check.py \
-                  --epsilon 0.2 \
+                  %s %s %s \
                   --data ${DATA_DIR}/%s \
                   --networkdefinition ${DATA_DIR}/%s \
                   --weights ${DATA_DIR}/%s"\
                 .replace("\
-                ", "") % (params["dataset_file"],
+                ", "") % (get_epsilon_args(params),
+                          get_sample_args(params),
+                          get_shard_args(params),
+                          params["dataset_file"],
                           params["networkdefinition_file"],
                           params["weights_file"])
 
@@ -74,6 +123,7 @@ def run_safe(args):
                 "memory": params.get("memory", "2Gb"),
                 "gpus": int(params.get("gpus", 0)),
                 "cpus": float(params.get("cpus", 2)),
+                "learners": int(params.get("learners", 1)),
                 "data_stores": [
                     {
                         "id": "robustness-check",
@@ -112,10 +162,10 @@ def run_safe(args):
                        "X-Watson-Userinfo": params["watson_auth_token"]}
             files = {'manifest': open('manifest.yml', 'rb'),
                      'model_definition': open('model.zip', 'rb')}
-            response = requests.post(url, headers=headers, files=files)
+            response = get_http_session().post(url, headers=headers, files=files)
             return json.loads(response.text or response.content or "{}")
 
-        cos = create_cos_connection(args)
+        cos = get_cos_resource(args)
         get_or_create_bucket(cos, get_data_bucket_name(args))
         get_or_create_bucket(cos, get_result_bucket_name(args))
         create_model_zip()
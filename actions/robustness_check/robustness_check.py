@@ -1,65 +1,238 @@
 import os
 import sys
 import json
+import time
+import h5py
 import numpy as np
-import numpy.linalg as la
 from keras.models import model_from_json
 from keras.utils import np_utils
-from art.attacks.fast_gradient import FastGradientMethod
 from art.classifiers.keras import KerasClassifier
 
 
-def get_metrics(model, x_original, x_adv_samples, y):
-    scores = model.evaluate(x_original, y, verbose=0)
-    model_accuracy_on_non_adversarial_samples = scores[1]
-
-    y_pred = model.predict(x_original, verbose=0)
-    y_pred_adv = model.predict(x_adv_samples, verbose=0)
-
-    scores = model.evaluate(x_adv_samples, y, verbose=0)
-    model_accuracy_on_adversarial_samples = scores[1]
-
-    pert_metric = get_perturbation_metric(x_original, x_adv_samples, y_pred, y_pred_adv, ord=2)
-    conf_metric = get_confidence_metric(y_pred, y_pred_adv)
-
-    data = {
-        "model accuracy on test data": float(model_accuracy_on_non_adversarial_samples),
-        "model accuracy on adversarial samples": float(model_accuracy_on_adversarial_samples),
-        "reduction in confidence": float(conf_metric),
-        "average perturbation": float(pert_metric)
-    }
-    return data
-
-
-def get_perturbation_metric(x_original, x_adv, y_pred, y_pred_adv, ord=2):
-    idxs = (np.argmax(y_pred_adv, axis=1) != np.argmax(y_pred, axis=1))
-
-    if np.sum(idxs) == 0.0:
-        return 0
-
-    perts_norm = la.norm((x_adv - x_original).reshape(x_original.shape[0], -1), ord, axis=1)
-    perts_norm = perts_norm[idxs]
-
-    return np.mean(perts_norm / la.norm(x_original[idxs].reshape(np.sum(idxs), -1), ord, axis=1))
-
-
-# This computes the change in confidence for all images in the test set
-def get_confidence_metric(y_pred, y_pred_adv):
+class RobustnessMetricsAccumulator(object):
+    """ Accumulates the robustness metrics batch by batch, so the test set never has to be held in memory at once
+    """
+
+    def __init__(self):
+        self.num_samples = 0
+        self.num_correct = 0
+        self.num_correct_adv = 0
+        self.perturbation_sum = 0.0
+        self.perturbation_sq_sum = 0.0
+        self.num_perturbed = 0
+        self.confidence_reduction_sum = 0.0
+        self.confidence_reduction_sq_sum = 0.0
+        self.num_unchanged = 0
+
+    def update(self, y, y_pred, y_pred_adv, x_original, x_adv_samples):
+        # accuracy comes from the predicted probabilities, so each input set needs only one forward pass
+        y_classidx = np.argmax(y, axis=1)
+        self.num_correct += int(np.sum(np.argmax(y_pred, axis=1) == y_classidx))
+        self.num_correct_adv += int(np.sum(np.argmax(y_pred_adv, axis=1) == y_classidx))
+        self.num_samples += y.shape[0]
+
+        perturbations, confidence_reductions = \
+            get_perturbation_and_confidence_sums(x_original, x_adv_samples, y_pred, y_pred_adv)
+        self.perturbation_sum += perturbations[0]
+        self.perturbation_sq_sum += perturbations[1]
+        self.num_perturbed += perturbations[2]
+        self.confidence_reduction_sum += confidence_reductions[0]
+        self.confidence_reduction_sq_sum += confidence_reductions[1]
+        self.num_unchanged += confidence_reductions[2]
+
+    def merge(self, other):
+        """ Add the sums accumulated by another accumulator, e.g. of another learner.
+        """
+        for key, value in other.__dict__.items():
+            setattr(self, key, getattr(self, key) + value)
+        return self
+
+    def to_json(self):
+        return dict(self.__dict__)
+
+    def merge_json(self, data):
+        other = RobustnessMetricsAccumulator()
+        other.__dict__.update(data)
+        return self.merge(other)
+
+    def get_metrics(self):
+        data = {
+            "model accuracy on test data": float(self.num_correct) / self.num_samples,
+            "model accuracy on adversarial samples": float(self.num_correct_adv) / self.num_samples,
+            "reduction in confidence": float(self.confidence_reduction_sum / self.num_unchanged
+                                             if self.num_unchanged else 0),
+            "average perturbation": float(self.perturbation_sum / self.num_perturbed if self.num_perturbed else 0)
+        }
+        return data
+
+    def get_confidence_intervals(self, population_size, z=1.96):
+        """ Normal approximation confidence intervals (95% by default) of the metrics of a random sample
+            drawn without replacement from population_size samples.
+        """
+        # finite population correction, the intervals shrink to zero width when the whole test set is checked
+        fpc = np.sqrt(max(population_size - self.num_samples, 0) / float(max(population_size - 1, 1)))
+
+        def proportion_interval(count, n):
+            p = float(count) / n
+            half_width = z * fpc * np.sqrt(p * (1 - p) / n)
+            return [float(max(p - half_width, 0.0)), float(min(p + half_width, 1.0))]
+
+        def mean_interval(total, sq_total, n):
+            # no interval for a metric without any samples, e.g. when no predicted class changed
+            if n == 0:
+                return None
+            mean = total / n
+            variance = max(sq_total - n * mean ** 2, 0.0) / max(n - 1, 1)
+            half_width = z * fpc * np.sqrt(variance / n)
+            return [float(mean - half_width), float(mean + half_width)]
+
+        intervals = {
+            "model accuracy on test data": proportion_interval(self.num_correct, self.num_samples),
+            "model accuracy on adversarial samples": proportion_interval(self.num_correct_adv, self.num_samples),
+            "reduction in confidence": mean_interval(self.confidence_reduction_sum,
+                                                     self.confidence_reduction_sq_sum, self.num_unchanged),
+            "average perturbation": mean_interval(self.perturbation_sum, self.perturbation_sq_sum, self.num_perturbed)
+        }
+        return intervals
+
+
+def get_perturbation_and_confidence_sums(x_original, x_adv, y_pred, y_pred_adv, block_size=256):
+    """ Sums (and sums of squares) of the relative L2 perturbation of the samples whose predicted class changed,
+        and of the relative reduction in confidence of the samples whose predicted class did not change, with
+        their counts.
+        The perturbation is computed in float32 over blocks of the changed samples only, reusing one buffer
+        instead of building x_adv - x_original for the whole batch.
+    """
+    num_samples = x_original.shape[0]
     y_classidx = np.argmax(y_pred, axis=1)
-    y_classconf = y_pred[np.arange(y_pred.shape[0]), y_classidx]
-
     y_adv_classidx = np.argmax(y_pred_adv, axis=1)
-    y_adv_classconf = y_pred_adv[np.arange(y_pred_adv.shape[0]), y_adv_classidx]
-
-    idxs = (y_classidx == y_adv_classidx)
 
-    if np.sum(idxs) == 0.0:
-        return 0
-
-    idxnonzero = y_classconf != 0
-    idxs = idxs & idxnonzero
-
-    return np.mean((y_classconf[idxs] - y_adv_classconf[idxs]) / y_classconf[idxs])
+    # reduction in confidence of the predicted class
+    y_classconf = y_pred[np.arange(num_samples), y_classidx].astype(np.float32)
+    y_adv_classconf = y_pred_adv[np.arange(num_samples), y_adv_classidx].astype(np.float32)
+    unchanged = (y_classidx == y_adv_classidx) & (y_classconf != 0)
+    confidence_reductions = (y_classconf[unchanged] - y_adv_classconf[unchanged]) / y_classconf[unchanged]
+
+    # perturbation relative to the original sample
+    changed = np.flatnonzero(y_classidx != y_adv_classidx)
+    x_original = x_original.reshape(num_samples, -1)
+    x_adv = x_adv.reshape(num_samples, -1)
+    perturbation_sum = 0.0
+    perturbation_sq_sum = 0.0
+    buffer = np.empty((min(block_size, changed.size), x_original.shape[1]), dtype=np.float32)
+    for start in range(0, changed.size, block_size):
+        block = changed[start:start + block_size]
+        diff = buffer[:block.size]
+        np.take(x_adv, block, axis=0, out=diff)
+        x_block = np.take(x_original, block, axis=0).astype(np.float32, copy=False)
+        np.subtract(diff, x_block, out=diff)
+        perts_norm = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+        perturbations = perts_norm / np.sqrt(np.einsum('ij,ij->i', x_block, x_block))
+        perturbation_sum += float(np.sum(perturbations, dtype=np.float64))
+        perturbation_sq_sum += float(np.sum(np.square(perturbations, dtype=np.float64)))
+
+    return ((perturbation_sum, perturbation_sq_sum, int(changed.size)),
+            (float(np.sum(confidence_reductions, dtype=np.float64)),
+             float(np.sum(np.square(confidence_reductions, dtype=np.float64))), int(np.sum(unchanged))))
+
+
+def get_gradient_sign(classifier, x, y_pred):
+    """ Sign of the loss gradient of untargeted FGSM, which does not depend on epsilon. Like ART's
+        FastGradientMethod, the model's own predictions y_pred are used as labels to avoid label leaking.
+    """
+    labels = (y_pred == np.max(y_pred, axis=1, keepdims=True)).astype('float32')
+    return np.sign(classifier.loss_gradient(x, labels)).astype(np.int8)
+
+
+def generate_adversarial_samples(x, gradient_sign, epsilon, clip_values=(0, 1)):
+    """ FGSM adversarial samples for one epsilon from the precomputed gradient sign
+    """
+    return np.clip(x + np.float32(epsilon) * gradient_sign, clip_values[0], clip_values[1])
+
+
+def append_to_dataset(h5_file, name, data, chunk_size=256):
+    """ Append a batch of samples to a resizable, compressed dataset of the HDF5 file, creating it for the first
+        batch. Every chunk holds up to chunk_size samples, so consumers can stream the dataset chunk by chunk.
+    """
+    if name not in h5_file:
+        h5_file.create_dataset(name, data=data, maxshape=(None,) + data.shape[1:],
+                               chunks=(min(chunk_size, data.shape[0]),) + data.shape[1:],
+                               compression="gzip", compression_opts=4, shuffle=True)
+    else:
+        dataset = h5_file[name]
+        dataset.resize(dataset.shape[0] + data.shape[0], axis=0)
+        dataset[-data.shape[0]:] = data
+
+
+def get_delta(x_original, x_adv, epsilon, dtype="int8"):
+    """ The perturbation x_adv - x_original in a compact dtype, int8 quantized in steps of epsilon / 127 (FGSM
+        perturbations lie within [-epsilon, epsilon]) or float16, and the scale to multiply it by.
+    """
+    delta = x_adv - x_original
+    if dtype == "float16":
+        return delta.astype(np.float16), 1.0
+    scale = epsilon / 127.0 if epsilon > 0 else 1.0
+    return np.clip(np.rint(delta / np.float32(scale)), -127, 127).astype(np.int8), scale
+
+
+def get_stratified_sample(y, sample_size, seed=0):
+    """ Sorted indices of a random sample of sample_size labels y, which keeps the proportion of every class.
+        Every class is represented by at least one sample, so sample_size must be at least the number of classes
+        and less than the number of labels.
+    """
+    rng = np.random.RandomState(seed)
+    classes, counts = np.unique(y, return_counts=True)
+    if not len(classes) <= sample_size < len(y):
+        raise ValueError("Expected a sample size from %d to %d, got %d" % (len(classes), len(y) - 1, sample_size))
+    # one sample of each class, the others in proportion to the samples left in each class
+    capacities = counts - 1
+    quotas = capacities * (sample_size - len(classes)) / float(np.sum(capacities))
+    sizes = np.floor(quotas).astype(int)
+    # distribute the samples lost by rounding down to the classes with the largest remainders
+    sizes[np.argsort(sizes - quotas, kind="mergesort")[:sample_size - len(classes) - np.sum(sizes)]] += 1
+    sizes += 1
+    indices = [rng.choice(np.flatnonzero(y == c), size, replace=False) for c, size in zip(classes, sizes)]
+    return np.sort(np.concatenate(indices))
+
+
+def get_shard_range(num_samples, shard_index, num_shards):
+    """ Index range [start, end) of the samples processed by one of num_shards learners
+    """
+    return num_samples * shard_index // num_shards, num_samples * (shard_index + 1) // num_shards
+
+
+def get_shard_metrics_file(result_dir, shard_index):
+    return os.path.join(result_dir, "metrics_shard_%d.json" % shard_index)
+
+
+def write_shard_metrics(result_dir, shard_index, accumulators):
+    # written to a temporary file first, so the reducing learner never reads a partial file
+    shard_metrics_file = get_shard_metrics_file(result_dir, shard_index)
+    with open(shard_metrics_file + ".tmp", "w") as f:
+        json.dump([accumulator.to_json() for accumulator in accumulators], f)
+    os.rename(shard_metrics_file + ".tmp", shard_metrics_file)
+
+
+def merge_shard_metrics(result_dir, num_shards, num_epsilons, timeout):
+    """ Reduce step: wait up to timeout seconds for the metric accumulators of all shards and merge them.
+        This assumes that all learners mount the same results bucket as RESULT_DIR (the mount_cos data store
+        of the manifest), otherwise the other learners' files are never visible.
+    """
+    accumulators = [RobustnessMetricsAccumulator() for i in range(num_epsilons)]
+    shard_metrics_files = [get_shard_metrics_file(result_dir, shard_index) for shard_index in range(num_shards)]
+    deadline = time.time() + timeout
+    missing_files = [f for f in shard_metrics_files if not os.path.exists(f)]
+    while missing_files:
+        if time.time() > deadline:
+            sys.exit("Timed out after %ds waiting for the metrics of %d of %d shards: %s"
+                     % (timeout, len(missing_files), num_shards, ", ".join(missing_files)))
+        time.sleep(10)
+        missing_files = [f for f in missing_files if not os.path.exists(f)]
+    for shard_metrics_file in shard_metrics_files:
+        with open(shard_metrics_file) as f:
+            for accumulator, data in zip(accumulators, json.load(f)):
+                accumulator.merge_json(data)
+    return accumulators
 
 
 def main(argv):
@@ -68,8 +241,15 @@ def main(argv):
 
     global network_definition_filename, weights_filename, dataset_filename
 
+    epsilons = None
+    batch_size = 1024
+    merge_timeout = 3600
+    sample_size = None
+    sample_fraction = None
+    seed = 0
+    delta_dtype = "int8"
     i = 1
-    while i <= 8:
+    while i < len(argv) - 1:
         arg = str(argv[i])
         print(arg)
         if arg == "--data":
@@ -79,13 +259,28 @@ def main(argv):
         if arg == "--weights":
             weights_filename = os.path.join(os.environ["DATA_DIR"], str(argv[i + 1]))
         if arg == "--epsilon":
-            epsilon = float(argv[i + 1])
+            epsilons = [float(argv[i + 1])]
+        if arg == "--epsilons":
+            epsilons = [float(epsilon) for epsilon in str(argv[i + 1]).split(",")]
+        if arg == "--batch_size":
+            batch_size = int(argv[i + 1])
+        if arg == "--merge_timeout":
+            merge_timeout = float(argv[i + 1])
+        if arg == "--sample":
+            sample_size = int(argv[i + 1])
+        if arg == "--sample_fraction":
+            sample_fraction = float(argv[i + 1])
+        if arg == "--seed":
+            seed = int(argv[i + 1])
+        if arg == "--delta_dtype":
+            delta_dtype = str(argv[i + 1])
 
         i += 2
 
     print("dataset: ", dataset_filename)
     print("network definition: ", network_definition_filename)
     print("weights: ", weights_filename)
+    print("epsilons: ", epsilons)
 
     # load & compile model
     json_file = open(network_definition_filename, 'r')
@@ -101,36 +296,99 @@ def main(argv):
     # create keras classifier
     classifier = KerasClassifier((0, 1), model)
 
-    # load data set
-    pf = np.load(dataset_filename)
-
-    x = pf['x_test']
-    y = pf['y_test']
-
-    # pre-process numpy array
-
-    x = np.expand_dims(x, axis=3)
-    x = x.astype('float32') / 255
-
-    y = np_utils.to_categorical(y, 10)
-
-    # craft adversarial samples using FGSM
-    crafter = FastGradientMethod(classifier, eps=epsilon)
-    x_samples = crafter.generate(x)
-
-    # obtain all metrics (robustness score, perturbation metric, reduction in confidence)
-    metrics = get_metrics(model, x, x_samples, y)
-
-    print("metrics: ", metrics)
+    # load data set, memory-mapped if it is a directory of npy files
+    if os.path.isdir(dataset_filename):
+        x = np.load(os.path.join(dataset_filename, 'x_test.npy'), mmap_mode='r')
+        y = np.load(os.path.join(dataset_filename, 'y_test.npy'), mmap_mode='r')
+    else:
+        pf = np.load(dataset_filename)
+
+        x = pf['x_test']
+        y = pf['y_test']
+
+    # optionally check a class-stratified random sample only, every learner draws the same sample
+    if sample_fraction is not None:
+        sample_size = int(round(sample_fraction * x.shape[0]))
+    if sample_size is not None and sample_size < x.shape[0]:
+        num_classes = len(np.unique(y))
+        if sample_size < num_classes:
+            sys.exit("The sample must contain at least one sample of each of the %d classes, got a sample size of %d."
+                     % (num_classes, sample_size))
+        indices = get_stratified_sample(np.asarray(y), sample_size, seed)
+        print("sample: %d of %d samples, seed: %d" % (sample_size, x.shape[0], seed))
+    else:
+        sample_size = None
+        indices = np.arange(x.shape[0])
+
+    # in a job with multiple learners every learner processes its own shard of the test set
+    num_shards = int(os.environ.get("NUM_LEARNERS", 1))
+    shard_index = int(os.environ.get("LEARNER_ID", 1)) - 1
+    start_index, end_index = get_shard_range(len(indices), shard_index, num_shards)
+    print("shard: %d of %d, samples: %d to %d" % (shard_index + 1, num_shards, start_index, end_index))
+
+    result_dir = os.environ["RESULT_DIR"]
+    report_file = os.path.join(result_dir, "report.txt")
+    adv_samples_file = os.path.join(result_dir, 'adv_samples.h5' if num_shards == 1
+                                    else 'adv_samples_%d.h5' % shard_index)
+
+    # generate, evaluate and store the adversarial samples one batch at a time to bound the memory usage
+    accumulators = [RobustnessMetricsAccumulator() for epsilon in epsilons]
+    # only the perturbation is stored, together with the test set indices and integer labels of the samples
+    with h5py.File(adv_samples_file, "w") as adv_samples:
+        for start in range(start_index, end_index, batch_size):
+            end = min(start + batch_size, end_index)
+            batch_indices = indices[start:end]
+
+            # pre-process numpy array
+            x_batch = np.expand_dims(x[batch_indices], axis=3)
+            x_batch = x_batch.astype('float32') / 255
+
+            y_batch = np_utils.to_categorical(y[batch_indices], 10)
+
+            append_to_dataset(adv_samples, "indices", batch_indices)
+            append_to_dataset(adv_samples, "labels", np.asarray(y[batch_indices]).astype(np.uint8))
+
+            # one forward pass over the original samples, shared by the attack and the metrics of all epsilons
+            y_pred = model.predict(x_batch, verbose=0)
+
+            # craft adversarial samples using FGSM, the gradient is computed once for all epsilons
+            gradient_sign = get_gradient_sign(classifier, x_batch, y_pred)
+            for epsilon, accumulator in zip(epsilons, accumulators):
+                x_samples = generate_adversarial_samples(x_batch, gradient_sign, epsilon)
+                y_pred_adv = model.predict(x_samples, verbose=0)
+
+                # accumulate all metrics (robustness score, perturbation metric, reduction in confidence)
+                accumulator.update(y_batch, y_pred, y_pred_adv, x_batch, x_samples)
+
+                delta_name = "delta" if len(epsilons) == 1 else "delta_%s" % epsilon
+                delta, scale = get_delta(x_batch, x_samples, epsilon, delta_dtype)
+                append_to_dataset(adv_samples, delta_name, delta)
+                adv_samples[delta_name].attrs["epsilon"] = epsilon
+                adv_samples[delta_name].attrs["scale"] = scale
+            print("processed samples: ", end - start_index)
+    print("adversarial samples saved to: ", adv_samples_file)
 
-    report_file = os.path.join(os.environ["RESULT_DIR"], "report.txt")
+    if num_shards > 1:
+        write_shard_metrics(result_dir, shard_index, accumulators)
+        if shard_index > 0:
+            return
+        # the first learner reduces the metrics of all shards into the report
+        accumulators = merge_shard_metrics(result_dir, num_shards, len(epsilons), merge_timeout)
+
+    robustness_curve = []
+    for epsilon, accumulator in zip(epsilons, accumulators):
+        metrics = accumulator.get_metrics()
+        if sample_size is not None:
+            metrics["sample size"] = sample_size
+            metrics["confidence intervals"] = accumulator.get_confidence_intervals(x.shape[0])
+        print("epsilon: ", epsilon, "metrics: ", metrics)
+        robustness_curve.append(dict(epsilon=epsilon, **metrics))
 
     with open(report_file, "w") as report:
-        report.write(json.dumps(metrics))
-
-    adv_samples_file = os.path.join(os.environ["RESULT_DIR"], 'adv_samples')
-    print("adversarial samples saved to: ", adv_samples_file)
-    np.savez(adv_samples_file, x_original=x, x_adversarial=x_samples, y=y)
+        if len(epsilons) == 1:
+            report.write(json.dumps(metrics))
+        else:
+            report.write(json.dumps({"robustness curve": robustness_curve}))
 
 
 if __name__ == "__main__":
@@ -1,16 +1,39 @@
 # OpenWhisk action to perform a model robustness check with ART on FfDL
 
-import json, requests
+import boto3
+import hashlib
+import json
+import re
+import requests
+import traceback
+import zipfile
+from ruamel.yaml import YAML
+
+# kept by warm containers
+_cos_resources = {}
+_http_session = None
+
+
+def get_cos_resource(params):
+    key = (params["aws_endpoint_url"], params["aws_access_key_id"],
+           hashlib.sha256(params["aws_secret_access_key"].encode()).hexdigest())
+    if key not in _cos_resources:
+        _cos_resources[key] = boto3.resource("s3",
+                                             endpoint_url=params["aws_endpoint_url"],
+                                             aws_access_key_id=params["aws_access_key_id"],
+                                             aws_secret_access_key=params["aws_secret_access_key"])
+    return _cos_resources[key]
+
+
+def get_http_session():
+    global _http_session
+    if _http_session is None:
+        _http_session = requests.Session()
+    return _http_session
 
 
 def run_safe(args):
     try:
-        import boto3
-        import re
-        import traceback
-        import zipfile
-        from ruamel.yaml import YAML
-
         yaml = YAML()
 
         script_file = "robustness_check.py"
@@ -20,13 +43,6 @@ def run_safe(args):
         def create_model_zip():
             zipfile.ZipFile(archive_file, mode='w').write(script_file)
 
-        def create_cos_connection(params):
-            cos = boto3.resource("s3",
-                                 endpoint_url=params["aws_endpoint_url"],
-                                 aws_access_key_id=params["aws_access_key_id"],
-                                 aws_secret_access_key=params["aws_secret_access_key"])
-            return cos
-
         def get_or_create_bucket(cos, bucket_name):
             bucket = cos.Bucket(bucket_name)
             if not bucket.creation_date:
@@ -37,18 +53,30 @@ def run_safe(args):
             if source_bucket != target_bucket or source_file != target_file:
                 target_bucket.copy({"Bucket": source_bucket.name, "Key": source_file}, target_file)
 
+        def object_exists(bucket, key):
+            try:
+                bucket.Object(key).load()
+                return True
+            except boto3.exceptions.botocore.client.ClientError as e:
+                if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                    return False
+                raise
+
         def copy_training_result_files(cos, params):
+            # returns the name of the copied label file, older training jobs only wrote y_test.out
             model_id = params["model_id"]
             trb = get_or_create_bucket(cos, params["training_results_bucket"])
             rdb = get_or_create_bucket(cos, params["robustnesscheck_data_bucket"])
-            for out_file in ["x_test.npy", "y_test.out", "model.pt"]:
+            label_file = "labels.npz" if object_exists(trb, "%s/labels.npz" % model_id) else "y_test.out"
+            for out_file in ["x_test.npy", label_file, "model.pt"]:
                 src_path = "%s/%s" % (model_id, out_file)
                 copy_file(trb, src_path, rdb, out_file)
+            return label_file
 
-        def create_manifest(params):
+        def create_manifest(params, label_file):
             training_command = "\
                 pip install https://github.com/IBM/adversarial-robustness-toolbox/zipball/master; \
-                python robustness_check.py --datax x_test.npy --datay y_test.out --weights model.pt --epsilon 0.2"
+                python robustness_check.py --datax x_test.npy --datay %s --weights model.pt --epsilon 0.2" % label_file
 
             manifest_dict = {
                 "name": params.get("training_job_name", "robustnesscheck_%s" % params["model_id"]),
@@ -90,15 +118,15 @@ def run_safe(args):
                        "X-Watson-Userinfo": params["watson_auth_token"]}
             files = {'manifest': open('manifest.yml', 'rb'),
                      'model_definition': open('model.zip', 'rb')}
-            response = requests.post(url, headers=headers, files=files)
+            response = get_http_session().post(url, headers=headers, files=files)
             return json.loads(response.text or response.content or "{}")
 
-        cos = create_cos_connection(args)
+        cos = get_cos_resource(args)
         get_or_create_bucket(cos, args["robustnesscheck_data_bucket"])
         get_or_create_bucket(cos, args["robustnesscheck_results_bucket"])
         create_model_zip()
-        create_manifest(args)
-        copy_training_result_files(cos, args)
+        label_file = copy_training_result_files(cos, args)
+        create_manifest(args, label_file)
         response = start_robustness_check(args)
         # OpenWhisk/IBM Cloud Functions does not return JSON when the returned dict contains key "error"
         if "error" in response:
@@ -5,8 +5,6 @@ import numpy.linalg as la
 import json
 
 import torch
-import torch.utils.data
-from torch.autograd import Variable
 
 from art.classifiers.pytorch import PyTorchClassifier
 from art.attacks.fast_gradient import FastGradientMethod
@@ -56,25 +54,23 @@ def get_metrics(model, x_original, x_adv_samples, y):
     return data, y_pred, y_pred_adv
 
 
-def evaluate(model, X_test, y_test):
+def inference_mode():
+    # torch.inference_mode is only available as of PyTorch 1.9
+    return torch.inference_mode() if hasattr(torch, "inference_mode") else torch.no_grad()
+
+
+def evaluate(model, X_test, y_test, batch_size=64):
     device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
-    test = torch.utils.data.TensorDataset(Variable(torch.FloatTensor(X_test.astype('float32'))), Variable(torch.LongTensor(y_test.astype('float32'))))
-    test_loader = torch.utils.data.DataLoader(test, batch_size=64, shuffle=False)
+    # the test set is shared with torch without a copy, the softmax outputs are written into a preallocated array
+    x = torch.from_numpy(np.ascontiguousarray(X_test, dtype=np.float32))
+    y_pred = np.empty((x.shape[0], model.fc2.out_features), dtype=np.float32)
+    y_pred_tensor = torch.from_numpy(y_pred)
     model.eval()
-    correct = 0
-    accuracy = 0
-    y_pred = []
-    with torch.no_grad():
-        for images, labels in test_loader:
-            images = images.to(device)
-            labels = labels.to(device)
-            outputs = model(images)
-            _, predicted = torch.max(outputs.data, 1)
-            predictions = torch.softmax(outputs.data, dim=1).detach().numpy()
-            correct += predicted.eq(labels.data.view_as(predicted)).sum().item()
-            y_pred += predictions.tolist()
-        accuracy = 1. * correct / len(test_loader.dataset)
-    y_pred = np.array(y_pred)
+    with inference_mode():
+        for start in range(0, x.shape[0], batch_size):
+            outputs = model(x[start:start + batch_size].to(device))
+            y_pred_tensor[start:start + batch_size].copy_(torch.softmax(outputs, dim=1))
+    accuracy = float(np.mean(np.argmax(y_pred, axis=1) == y_test)) if len(y_pred) else 0.0
     return accuracy, y_pred
 
 
@@ -146,7 +142,11 @@ def main(argv):
 
     # load data set
     x = np.load(dataset_filenamex)
-    y = np.loadtxt(dataset_filenamey)
+    if dataset_filenamey.endswith(".npz"):
+        with np.load(dataset_filenamey) as f:
+            y = f['y_test']
+    else:
+        y = np.loadtxt(dataset_filenamey)
 
     # craft adversarial samples using FGSM
     crafter = FastGradientMethod(classifier, eps=epsilon)
@@ -1,12 +1,19 @@
 import glob
+import hashlib
+import io
+import itertools
+import os
+import tarfile
+import time
 import numpy as np
 import argparse
 import torch
 import torch.nn as nn
 import torch.utils.data
-from torch.autograd import Variable
 from torchsummary import summary
 from PIL import Image
+from functools import partial
+from multiprocessing import Pool
 
 
 np.random.seed(99)
@@ -40,14 +47,161 @@ class ThreeLayerCNN(torch.nn.Module):
         return x
 
 
+def parse_image_name(image_path):
+    # UTKFace image names start with "[age]_[gender]_[race]_"
+    age, gender, race = os.path.basename(image_path).split("_")[:3]
+    return int(age), int(gender), int(race)
+
+
+def decode_image(image, img_size):
+    # the image is either a file path or the raw bytes of a JPEG file
+    try:
+        if isinstance(image, bytes):
+            image = io.BytesIO(image)
+        return np.array(Image.open(image).resize((img_size, img_size)))
+    except Exception:
+        return None
+
+
+def decode_sample(sample, img_size):
+    image_path, image, labels = sample
+    return image_path, decode_image(image, img_size), labels
+
+
+def iter_directory_images(image_dir, races_to_consider):
+    for image_path in glob.glob(image_dir + "*.jpg"):
+        try:
+            age, gender, race = parse_image_name(image_path)
+        except ValueError:
+            print("Missing: " + image_path)
+            continue
+        if race in races_to_consider:
+            yield image_path, image_path, (gender, race, age)
+
+
+def iter_archive_images(archive_file, races_to_consider):
+    # read the members of the (gzipped) tar archive in order as a stream, without extracting it
+    with tarfile.open(archive_file, mode='r|*') as archive:
+        for member in archive:
+            if not member.isfile() or not member.name.endswith(".jpg"):
+                continue
+            try:
+                age, gender, race = parse_image_name(member.name)
+            except ValueError:
+                print("Missing: " + member.name)
+                continue
+            if race in races_to_consider:
+                yield member.name, archive.extractfile(member).read(), (gender, race, age)
+
+
+def get_cache_file(cache_dir, image_dir, img_size, races_to_consider):
+    key = "%s:%d:%s" % (os.path.abspath(image_dir), img_size, races_to_consider)
+    return os.path.join(cache_dir, "UTKFace_%d_%s.npz" % (img_size, hashlib.md5(key.encode()).hexdigest()[:12]))
+
+
+def load_images(image_dir, img_size, races_to_consider, num_workers=None, cache_dir=None, max_pending_images=2048):
+    """ Decode and resize the images of a directory or a tar.gz archive in a process pool,
+        and cache the decoded images in cache_dir. At most max_pending_images undecoded images
+        are read ahead of the pool, so an archive is streamed instead of read into memory.
+    """
+    cache_file = get_cache_file(cache_dir, image_dir, img_size, races_to_consider) if cache_dir else None
+    if cache_file and os.path.exists(cache_file):
+        print("Loading decoded images from " + cache_file)
+        with np.load(cache_file) as f:
+            return f['image'], f['gender'], f['race'], f['age']
+
+    if os.path.isfile(image_dir):
+        samples = iter_archive_images(image_dir, races_to_consider)
+    else:
+        samples = iter_directory_images(image_dir, races_to_consider)
+
+    feature_image = []
+    outcome_gender = []
+    protected_race = []
+    feature_age = []
+    with Pool(num_workers) as pool:
+        # imap alone would drain the samples generator as fast as it can, so feed it bounded slices
+        for batch in iter(lambda: list(itertools.islice(samples, max_pending_images)), []):
+            for image_path, image, (gender, race, age) in pool.imap(partial(decode_sample, img_size=img_size),
+                                                                    batch, chunksize=64):
+                if image is None:
+                    print("Missing: " + image_path)
+                    continue
+                feature_image.append(image)
+                outcome_gender.append(gender)
+                protected_race.append(race)
+                feature_age.append(age)
+
+    feature_image_mat = np.array(feature_image, dtype=np.uint8)
+    outcome_gender_mat = np.array(outcome_gender)
+    protected_race_mat = np.array(protected_race)
+    age_mat = np.array(feature_age)
+
+    if cache_file:
+        try:
+            np.savez(cache_file, image=feature_image_mat, gender=outcome_gender_mat, race=protected_race_mat, age=age_mat)
+            print("Decoded images cached in " + cache_file)
+        except (IOError, OSError) as e:
+            print("Could not cache decoded images: " + str(e))
+
+    return feature_image_mat, outcome_gender_mat, protected_race_mat, age_mat
+
+
+def normalize_images(images):
+    """ Convert a batch of uint8 images (NHWC) to a float32 tensor (NCHW) with values in [-1, 1).
+    """
+    images = torch.from_numpy(np.ascontiguousarray(images))
+    return (images.permute(0, 3, 1, 2).float() * (2.0 / 256.0) - 1.0).contiguous()
+
+
+class ImageDataset(torch.utils.data.Dataset):
+    """ Serves the images selected by indices as uint8, they are normalized per batch by collate_images.
+    """
+    def __init__(self, images, labels, indices):
+        self.images = images
+        self.labels = labels
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        i = self.indices[idx]
+        return self.images[i], int(self.labels[i])
+
+
+def collate_images(batch):
+    images, labels = zip(*batch)
+    return normalize_images(np.stack(images)), torch.LongTensor(labels)
+
+
+def save_normalized_images(filename, images, indices, chunk_size=1024):
+    # write the normalized images chunk by chunk, without a float32 copy of all images in memory
+    x = np.lib.format.open_memmap(filename, mode='w+', dtype='float32',
+                                  shape=(len(indices),) + normalize_images(images[:1]).shape[1:])
+    for start in range(0, len(indices), chunk_size):
+        x[start:start + chunk_size] = normalize_images(images[indices[start:start + chunk_size]]).numpy()
+    x.flush()
+    del x
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('--data_dir', type=str, help='Dataset directory path')
+    parser.add_argument('--data_dir', type=str, help='Dataset directory or tar.gz archive path')
     parser.add_argument('--result_path', type=str, help='Result model path')
     parser.add_argument('--label_dir', type=str, help='Label directory path')
+    parser.add_argument('--cache_dir', type=str, help='Directory to cache the decoded images in')
+    parser.add_argument('--decode_workers', type=int, help='Number of processes decoding images (default: CPU count)')
+    parser.add_argument('--batch_size', type=int, default=64, help='Training and test batch size')
+    parser.add_argument('--num_workers', type=int, default=0, help='Number of data loader worker processes')
+    parser.add_argument('--num_threads', type=int, help='Number of threads used by torch (default: torch default)')
+    parser.add_argument('--text_labels', action='store_true', help='Also save the labels as text files (*.out)')
     args = parser.parse_args()
 
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
     image_dir = args.data_dir
     result_dir = args.result_path
     label_dir = args.label_dir
@@ -62,42 +216,19 @@ if __name__ == "__main__":
 
     img_size = 64
 
-    protected_race = []
-    outcome_gender = []
-    feature_image = []
-    feature_age = []
-
-    for i, image_path in enumerate(glob.glob(image_dir + "*.jpg")):
-        try:
-            age, gender, race = image_path.split('/')[-1].split("_")[:3]
-            age = int(age)
-            gender = int(gender)
-            race = int(race)
-
-            if race in races_to_consider:
-                protected_race.append(race)
-                outcome_gender.append(gender)
-                feature_image.append(np.array(Image.open(image_path).resize((img_size, img_size))))
-                feature_age.append(age)
-        except:
-            print("Missing: " + image_path)
-
-    feature_image_mat = np.array(feature_image)
-    outcome_gender_mat =  np.array(outcome_gender)
-    protected_race_mat =  np.array(protected_race)
-    age_mat = np.array(feature_age)
+    feature_image_mat, outcome_gender_mat, protected_race_mat, age_mat = \
+        load_images(image_dir, img_size, races_to_consider, num_workers=args.decode_workers, cache_dir=args.cache_dir)
 
     """ Split the dataset into train and test """
 
-    feature_image_mat_normed = 2.0 *feature_image_mat.astype('float32')/256.0 - 1.0
-
-    N = len(feature_image_mat_normed)
+    # the images are kept as uint8 and only normalized batch by batch
+    N = len(feature_image_mat)
     ids = np.random.permutation(N)
     train_size=int(0.7 * N)
-    X_train = feature_image_mat_normed[ids[0:train_size]]
-    y_train = outcome_gender_mat[ids[0:train_size]]
-    X_test = feature_image_mat_normed[ids[train_size:]]
-    y_test = outcome_gender_mat[ids[train_size:]]
+    train_ids = ids[0:train_size]
+    test_ids = ids[train_size:]
+    y_train = outcome_gender_mat[train_ids]
+    y_test = outcome_gender_mat[test_ids]
 
     p_train = protected_race_mat[ids[0:train_size]]
     p_test = protected_race_mat[ids[train_size:]]
@@ -105,17 +236,19 @@ if __name__ == "__main__":
     age_train = age_mat[ids[0:train_size]]
     age_test = age_mat[ids[train_size:]]
 
-    batch_size = 64
+    batch_size = args.batch_size
 
-    X_train = X_train.transpose(0,3,1,2)
-    X_test = X_test.transpose(0,3,1,2)
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    loader_args = {'batch_size': batch_size,
+                   'num_workers': args.num_workers,
+                   'pin_memory': device.type == 'cuda',
+                   'collate_fn': collate_images}
 
-    train = torch.utils.data.TensorDataset(Variable(torch.FloatTensor(X_train.astype('float32'))), Variable(torch.LongTensor(y_train.astype('float32'))))
-    train_loader = torch.utils.data.DataLoader(train, batch_size=batch_size, shuffle=True)
-    test = torch.utils.data.TensorDataset(Variable(torch.FloatTensor(X_test.astype('float32'))), Variable(torch.LongTensor(y_test.astype('float32'))))
-    test_loader = torch.utils.data.DataLoader(test, batch_size=batch_size, shuffle=False)
+    train = ImageDataset(feature_image_mat, outcome_gender_mat, train_ids)
+    train_loader = torch.utils.data.DataLoader(train, shuffle=True, **loader_args)
+    test = ImageDataset(feature_image_mat, outcome_gender_mat, test_ids)
+    test_loader = torch.utils.data.DataLoader(test, shuffle=False, **loader_args)
 
-    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
     model = ThreeLayerCNN().to(device)
     summary(model, (3,img_size,img_size))
 
@@ -133,6 +266,7 @@ if __name__ == "__main__":
     # Start training the model
     num_batches = len(train_loader)
     for epoch in range(num_epochs):
+        epoch_start_time = time.time()
         for idx, (images, labels) in enumerate(train_loader):
             images = images.to(device)
             labels = labels.to(device)
@@ -146,6 +280,9 @@ if __name__ == "__main__":
             if (idx+1) % print_freq == 0:
                 print ('Epoch [{}/{}], Step [{}/{}], Loss: {:.4f}' .format(epoch+1, num_epochs, idx+1, num_batches, loss.item()))
 
+        epoch_time = time.time() - epoch_start_time
+        print ('Epoch [{}/{}], Time: {:.1f}s, Samples/sec: {:.1f}' .format(epoch+1, num_epochs, epoch_time, len(train) / epoch_time))
+
     # Run model on test set in eval mode.
     model.eval()
     correct = 0
@@ -166,12 +303,16 @@ if __name__ == "__main__":
     torch.save(model.state_dict(), result_dir)
     print("Model saved at " + result_dir)
 
-    # Save labels and protected features for fairness check.
-    np.savetxt(label_dir + '/y_train.out', y_train)
-    np.savetxt(label_dir + '/p_train.out', p_train)
-    np.savetxt(label_dir + '/y_test.out', y_test)
-    np.savetxt(label_dir + '/p_test.out', p_test)
-    np.savetxt(label_dir + '/y_pred.out', y_pred)
-    np.save(label_dir + '/x_test', X_test)
+    # Save labels and protected features for fairness check as integer arrays in one binary file,
+    # the text files are only written for older consumers
+    np.savez_compressed(label_dir + '/labels.npz', y_train=y_train, p_train=p_train,
+                        y_test=y_test, p_test=p_test, y_pred=y_pred, age_train=age_train, age_test=age_test)
+    if args.text_labels:
+        np.savetxt(label_dir + '/y_train.out', y_train)
+        np.savetxt(label_dir + '/p_train.out', p_train)
+        np.savetxt(label_dir + '/y_test.out', y_test)
+        np.savetxt(label_dir + '/p_test.out', p_test)
+        np.savetxt(label_dir + '/y_pred.out', y_pred)
+    save_normalized_images(label_dir + '/x_test.npy', feature_image_mat, test_ids)
 
     print("Labels stored at directory " + label_dir)
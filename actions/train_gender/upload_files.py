@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 
+import argparse
 import boto3
+import hashlib
 import json
 import os
 import sys
+import time
 import yaml
 import zipfile
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
 
 training_files_folder = "training_files"
 
@@ -53,14 +58,69 @@ def download_training_data(dataset_file):
 
 
 def create_model_zip():
-    zipfile.ZipFile(archive_file, mode='w').write(script_file, os.path.basename(script_file))
-
-
-def upload_files_to_bucket(bucket, files=[manifest_file, archive_file, dataset_file]):
+    with zipfile.ZipFile(archive_file, mode='w') as archive:
+        archive.write(script_file, os.path.basename(script_file))
+
+
+def get_file_hashes(filename):
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+            sha256.update(chunk)
+    return md5.hexdigest(), sha256.hexdigest()
+
+
+def is_file_unchanged(bucket, key, md5, sha256):
+    # files uploaded by this script carry their SHA-256 in the object metadata, for other
+    # files the ETag is the MD5 of the content unless they were uploaded in multiple parts
+    try:
+        obj = bucket.meta.client.head_object(Bucket=bucket.name, Key=key)
+    except boto3.exceptions.botocore.client.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    return obj.get('Metadata', {}).get('sha256') == sha256 or obj['ETag'].strip('"') == md5
+
+
+def get_transfer_config(args):
+    return TransferConfig(multipart_threshold=args.part_size * 1024 * 1024,
+                          multipart_chunksize=args.part_size * 1024 * 1024,
+                          max_concurrency=args.max_concurrency)
+
+
+def upload_file(bucket, filename, transfer_config, force=False):
+    # use the low-level client, unlike boto3 resources it can be shared by multiple threads
+    key = os.path.basename(filename)
+    size = os.path.getsize(filename)
+    md5, sha256 = get_file_hashes(filename)
+    if not force and is_file_unchanged(bucket, key, md5, sha256):
+        print('- {} (unchanged, skipped)'.format(filename))
+        return 0, size
+    start_time = time.time()
+    bucket.meta.client.upload_file(filename, bucket.name, key,
+                                   ExtraArgs={'Metadata': {'sha256': sha256}},
+                                   Config=transfer_config)
+    elapsed_time = max(time.time() - start_time, 1e-6)
+    print('- {} ({:4.2f}kB in {:4.2f}s, {:4.2f}MB/s)'.format(filename, size/1024, elapsed_time,
+                                                           size/1024/1024/elapsed_time))
+    return size, 0
+
+
+def upload_files_to_bucket(bucket, files=[manifest_file, archive_file, dataset_file], force=False,
+                           parallel=False, transfer_config=None):
     print('Uploading files to bucket "{}":'.format(bucket.name))
-    for filename in files:
-        print('- {}'.format(filename))
-        bucket.upload_file(filename, os.path.basename(filename))
+    transfer_config = transfer_config or TransferConfig()
+    if parallel:
+        with ThreadPoolExecutor(max_workers=max(1, len(files))) as executor:
+            results = list(executor.map(lambda filename: upload_file(bucket, filename, transfer_config, force),
+                                        files))
+    else:
+        results = [upload_file(bucket, filename, transfer_config, force) for filename in files]
+    bytes_sent = sum(sent for sent, _ in results)
+    bytes_skipped = sum(skipped for _, skipped in results)
+    print('Sent {:4.2f}kB, skipped {:4.2f}kB of unchanged files'.format(bytes_sent/1024, bytes_skipped/1024))
 
 
 def print_bucket_contents(bucket):
@@ -82,14 +142,25 @@ def generate_parameters_file(manifest):
         json.dump(parameters, f, sort_keys=True, indent=4, )
 
 
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--force', action='store_true', help='Upload files even if they did not change')
+    parser.add_argument('--parallel', action='store_true', help='Upload all files at the same time')
+    parser.add_argument('--part_size', type=int, default=16, help='Multipart upload part size in MB')
+    parser.add_argument('--max_concurrency', type=int, default=10, help='Number of threads uploading parts of a file')
+    return parser.parse_args(args[1:])
+
+
 def main(args):
+    args = parse_args(args)
     manifest_data = parse_manifest()
     cos = create_cos_connection(manifest_data)
     data_bucket = create_bucket(cos, bucket_name=manifest_data["data_stores"][0]["training_data"]["container"])
     result_bucket = create_bucket(cos, bucket_name=manifest_data["data_stores"][0]["training_results"]["container"])
     download_training_data(dataset_file)
     create_model_zip()
-    upload_files_to_bucket(data_bucket, files=[manifest_file, archive_file, dataset_file])
+    upload_files_to_bucket(data_bucket, files=[manifest_file, archive_file, dataset_file], force=args.force,
+                           parallel=args.parallel, transfer_config=get_transfer_config(args))
     print_bucket_contents(data_bucket)
     generate_parameters_file(manifest_data)
 
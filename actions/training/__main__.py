@@ -1,34 +1,93 @@
 # OpenWhisk action to train a deep learning model with FfDL
 
+import boto3, json, requests, traceback, uuid
+
+# COS resources per credentials and the HTTP session, kept by warm containers
+_cos_resources = {}
+_http_session = None
+
+
+def get_cos_resource(params):
+    key = (params["aws_endpoint_url"], params["aws_access_key_id"],
+           hashlib.sha256(params["aws_secret_access_key"].encode()).hexdigest())
+    if key not in _cos_resources:
+        _cos_resources[key] = boto3.resource("s3",
+                                             endpoint_url=params["aws_endpoint_url"],
+                                             aws_access_key_id=params["aws_access_key_id"],
+                                             aws_secret_access_key=params["aws_secret_access_key"])
+    return _cos_resources[key]
+
+
+def get_http_session():
+    global _http_session
+    if _http_session is None:
+        _http_session = requests.Session()
+    return _http_session
+
 
 def run_safe(parameters):
     try:
-        import boto3, json, requests, os, sys, traceback
+        # multipart form field name -> object key in the training data bucket
+        model_files = [("manifest", "manifest.yml"),
+                       ("model_definition", "model.zip")]
+
+        chunk_size = 64 * 1024
 
-        def download_files_from_s3(params):
-            cos = boto3.resource("s3",
-                                 aws_access_key_id=params["aws_access_key_id"],
-                                 aws_secret_access_key=params["aws_secret_access_key"],
-                                 endpoint_url=params["aws_endpoint_url"])
+        def download_files_from_s3(cos, params):
             bucket = cos.Bucket(params["training_data_bucket"])
-            bucket.download_file("model.zip", "model.zip")
-            bucket.download_file("manifest.yml", "manifest.yml")
+            for _, key in model_files:
+                bucket.download_file(key, key)
 
-        def train_model(params):
-            url = "%s/v1/models?version=2017-02-13" % params["ffdl_service_url"]
-            headers = {
+        def get_request_headers(params):
+            return {
                 "Accept": "application/json",
                 "Authorization": params["basic_authtoken"],
                 "X-Watson-Userinfo": params["watson_auth_token"]
             }
-            files = {'manifest': open('manifest.yml', 'rb'),
-                     'model_definition': open('model.zip', 'rb')}
-            response = requests.post(url, headers=headers, files=files)
+
+        def train_model(params):
+            url = "%s/v1/models?version=2017-02-13" % params["ffdl_service_url"]
+            headers = get_request_headers(params)
+            with open('manifest.yml', 'rb') as manifest, open('model.zip', 'rb') as model_definition:
+                files = {'manifest': manifest,
+                         'model_definition': model_definition}
+                response = get_http_session().post(url, headers=headers, files=files)
+            result = json.loads(response.text or response.content or "{}")
+            return result
+
+        def stream_multipart_body(cos, params, boundary):
+            # yield the multipart/form-data body chunk by chunk while reading the S3 objects, so the
+            # model files are neither written to the local disk nor held in memory as a whole
+            for field_name, key in model_files:
+                s3_object = cos.Object(params["training_data_bucket"], key).get()
+                yield ('--%s\r\n'
+                       'Content-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                       '\r\n' % (boundary, field_name, key)).encode("utf-8")
+                body = s3_object["Body"]
+                try:
+                    for chunk in iter(lambda: body.read(chunk_size), b""):
+                        yield chunk
+                finally:
+                    body.close()
+                yield b"\r\n"
+            yield ("--%s--\r\n" % boundary).encode("utf-8")
+
+        def train_model_streaming(cos, params):
+            url = "%s/v1/models?version=2017-02-13" % params["ffdl_service_url"]
+            boundary = uuid.uuid4().hex
+            headers = get_request_headers(params)
+            headers["Content-Type"] = "multipart/form-data; boundary=%s" % boundary
+            # a generator as request body makes requests send it with "Transfer-Encoding: chunked"
+            response = get_http_session().post(url, headers=headers, data=stream_multipart_body(cos, params, boundary))
             result = json.loads(response.text or response.content or "{}")
             return result
 
-        download_files_from_s3(parameters)
-        result = train_model(parameters)
+        cos = get_cos_resource(parameters)
+        if parameters.get("stream_model_files", False):
+            result = train_model_streaming(cos, parameters)
+        else:
+            download_files_from_s3(cos, parameters)
+            result = train_model(parameters)
         return result or dict()
     except Exception as e:
         # print('%s: %s\n%s' % (e.__class__.__name__, str(e), traceback.format_exc()))
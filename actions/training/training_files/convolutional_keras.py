@@ -28,35 +28,57 @@ def main(argv):
         i += 2
 
 
+class MemoryMappedBatches(keras.utils.Sequence):
+    # reads batches from memory-mapped arrays and normalizes them one batch at a time, so the
+    # resident memory is bounded by the batch size instead of the size of the data set
+    def __init__(self, x, y, batch_size):
+        self.x, self.y, self.batch_size = x, y, batch_size
+
+    def __len__(self):
+        return int(np.ceil(len(self.x) / float(self.batch_size)))
+
+    def __getitem__(self, idx):
+        batch = slice(idx * self.batch_size, (idx + 1) * self.batch_size)
+        x_batch = self.x[batch].reshape((-1,) + input_shape).astype('float32') / 255
+        y_batch = keras.utils.to_categorical(self.y[batch], num_classes)
+        return x_batch, y_batch
+
+
 if __name__ == "__main__":
     main(sys.argv)
 
 
-# load mnist npz file
-f = np.load(image_path)
-x_train = f['x_train']
-y_train = f['y_train']
-x_test = f['x_test']
-y_test = f['y_test']
-f.close()
-
 if K.image_data_format() == 'channels_first':
-    x_train = x_train.reshape(x_train.shape[0], 1, img_rows, img_cols)
-    x_test = x_test.reshape(x_test.shape[0], 1, img_rows, img_cols)
     input_shape = (1, img_rows, img_cols)
 else:
-    x_train = x_train.reshape(x_train.shape[0], img_rows, img_cols, 1)
-    x_test = x_test.reshape(x_test.shape[0], img_rows, img_cols, 1)
     input_shape = (img_rows, img_cols, 1)
 
-x_train = x_train.astype('float32')
-x_test = x_test.astype('float32')
-x_train /= 255
-x_test /= 255
+# a directory of uncompressed npy files can be memory-mapped, a (compressed) npz file is loaded into memory
+memory_mapped = os.path.isdir(image_path)
 
-# convert class vectors to binary class matrices
-y_train = keras.utils.to_categorical(y_train, num_classes)
-y_test = keras.utils.to_categorical(y_test, num_classes)
+if memory_mapped:
+    x_train, y_train, x_test, y_test = [np.load(os.path.join(image_path, name + '.npy'), mmap_mode='r')
+                                        for name in ['x_train', 'y_train', 'x_test', 'y_test']]
+else:
+    # load mnist npz file
+    f = np.load(image_path)
+    x_train = f['x_train']
+    y_train = f['y_train']
+    x_test = f['x_test']
+    y_test = f['y_test']
+    f.close()
+
+    x_train = x_train.reshape((x_train.shape[0],) + input_shape)
+    x_test = x_test.reshape((x_test.shape[0],) + input_shape)
+
+    x_train = x_train.astype('float32')
+    x_test = x_test.astype('float32')
+    x_train /= 255
+    x_test /= 255
+
+    # convert class vectors to binary class matrices
+    y_train = keras.utils.to_categorical(y_train, num_classes)
+    y_test = keras.utils.to_categorical(y_test, num_classes)
 
 # model
 model = Sequential()
@@ -74,9 +96,16 @@ model.add(Dense(num_classes, activation='softmax'))
 model.compile(loss=keras.losses.categorical_crossentropy,
               optimizer=keras.optimizers.Adadelta(),
               metrics=['accuracy'])
-model.fit(x_train, y_train, batch_size=batch_size, epochs=epochs, verbose=1, validation_split=0.1)
-
-score = model.evaluate(x_test, y_test, verbose=0)
+if memory_mapped:
+    # like validation_split=0.1, use the last 10% of the training data for validation
+    split_at = int(len(x_train) * 0.9)
+    model.fit_generator(MemoryMappedBatches(x_train[:split_at], y_train[:split_at], batch_size),
+                        epochs=epochs, verbose=1, shuffle=True,
+                        validation_data=MemoryMappedBatches(x_train[split_at:], y_train[split_at:], batch_size))
+    score = model.evaluate_generator(MemoryMappedBatches(x_test, y_test, batch_size))
+else:
+    model.fit(x_train, y_train, batch_size=batch_size, epochs=epochs, verbose=1, validation_split=0.1)
+    score = model.evaluate(x_test, y_test, verbose=0)
 
 print('Test loss:', score[0])
 print('Test accuracy:', score[1])